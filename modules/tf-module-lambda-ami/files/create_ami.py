@@ -1,10 +1,14 @@
 import boto3
 import collections
 import datetime
+import itertools
 import time
 import os
 import copy
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import throttle
 
 logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
 logger = logging.getLogger(__name__)
@@ -16,6 +20,19 @@ if "region" in os.environ and os.environ["region"] != "":
 else:
     ec = boto3.client('ec2')
 
+# AMIs are created by this many threads, making up to api_rate calls per
+# second between them
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_API_RATE = 5
+# Most AMIs tagged by one create_tags call
+CREATE_TAGS_BATCH_SIZE = 500
+# The names of the AMIs this function creates
+IMAGE_NAME_PATTERN = 'Lambda - i-*'
+# Only AMIs created this long ago or less are adopted: the ones the previous
+# hourly run created and this one. Older untagged AMIs may have been untagged
+# on purpose to keep them.
+ADOPT_WINDOW_IN_HOURS = 2
+
 
 def get_tags_for_ami(instance, retention_hours):
     delete_date = datetime.datetime.now() + datetime.timedelta(
@@ -54,6 +71,12 @@ def get_environment(name, default):
     return val
 
 
+def get_optional_environment(name, default):
+    if name not in os.environ or os.environ[name] == "":
+        return default
+    return get_environment(name, default)
+
+
 def check_backup_time(backup_times, current_hour):
     for t in backup_times.split(','):
         try:
@@ -65,6 +88,30 @@ def check_backup_time(backup_times, current_hour):
     return False
 
 
+def backup_time_filter_values(hour):
+    # Patterns of the BackupTimes tag values that list hour, for a server side
+    # filter. They match a few more values than that, e.g. "1 8", so the
+    # instances found are checked with check_backup_time() again.
+    values = []
+    for hour_value in sorted({str(hour), '{:02d}'.format(hour)}):
+        for prefix in ('', '*,', '* '):
+            for suffix in ('', ',*', ' *'):
+                values.append(prefix + hour_value + suffix)
+    return values
+
+
+def get_instances(current_hour, default_backup_time):
+    # The instances with a backup tag that can be due at current_hour. Unless
+    # it is the default time, when the ones without a BackupTimes tag are due
+    # too, only the ones whose BackupTimes lists current_hour are described.
+    filters = [{'Name': 'tag:Backup', 'Values': ['True', 'true']}]
+    if current_hour != default_backup_time:
+        filters.append({'Name': 'tag:BackupTimes', 'Values': backup_time_filter_values(current_hour)})
+    pages = ec.get_paginator('describe_instances').paginate(Filters=filters)
+    return list(itertools.chain.from_iterable(
+        reservation['Instances'] for page in pages for reservation in page.get('Reservations', [])))
+
+
 def convert_retention(string):
     try:
         if string[-1] == 'h':
@@ -101,31 +148,86 @@ def get_retention_for_run(retentions, backup_times, current_hour):
     return convert_retention(retentions[0])
 
 
+def create_image(bucket, instance, tags):
+    # Create format needs to end with the date because delete_ami is
+    # looking for a backup with current date at the end.
+    create_fmt = datetime.datetime.now().strftime('%H.%M.%S on %Y-%m-%d')
+
+    # The AMI and its snapshots are tagged by the same call, so there is no
+    # AMI without a DeleteOn tag even when the function times out
+    tag_list = ansible_dict_to_boto3_tag_list(tags)
+    return throttle.call(bucket, ec.create_image,
+                         InstanceId=instance['InstanceId'],
+                         Name="Lambda - " + instance['InstanceId'] +
+                         " from " + create_fmt,
+                         Description="Lambda created AMI of " +
+                         "instance " + instance['InstanceId'],
+                         NoReboot=True,
+                         DryRun=False,
+                         TagSpecifications=[
+                             {'ResourceType': 'image', 'Tags': tag_list},
+                             {'ResourceType': 'snapshot', 'Tags': tag_list},
+                         ])
+
+
+def tag_images(bucket, to_tag):
+    # AMIs that get the same tags are tagged together
+    images_by_tags = collections.defaultdict(list)
+    for ami, tags in to_tag.items():
+        images_by_tags[tuple(sorted(tags.items()))].append(ami)
+    for tags, amis in images_by_tags.items():
+        for start in range(0, len(amis), CREATE_TAGS_BATCH_SIZE):
+            throttle.call(bucket, ec.create_tags,
+                          Resources=amis[start:start + CREATE_TAGS_BATCH_SIZE],
+                          Tags=ansible_dict_to_boto3_tag_list(dict(tags)))
+
+
+def adopt_untagged_images(bucket, retention_hours):
+    # Recent AMIs of this function without a DeleteOn tag, e.g. left behind by
+    # runs that timed out before tagging them, are never deleted by
+    # delete_ami. They get one retention_hours after they were created.
+    adopt_after = datetime.datetime.utcnow() - datetime.timedelta(hours=ADOPT_WINDOW_IN_HOURS)
+    pages = ec.get_paginator('describe_images').paginate(
+        Owners=['self'],
+        Filters=[{'Name': 'name', 'Values': [IMAGE_NAME_PATTERN]}])
+    to_tag = {}
+    for image in itertools.chain.from_iterable(page.get('Images', []) for page in pages):
+        if 'DeleteOn' in boto3_tag_list_to_ansible_dict(image.get('Tags', [])):
+            continue
+        created = datetime.datetime.strptime(image['CreationDate'], '%Y-%m-%dT%H:%M:%S.%fZ')
+        if created < adopt_after:
+            continue
+        delete_date = created + datetime.timedelta(hours=retention_hours)
+        to_tag[image['ImageId']] = {
+            os.environ.get('tagname', 'ApplicationRole'): 'Backup',
+            'DeleteOn': delete_date.strftime('%Y-%m-%d-%H'),
+        }
+        logger.warning("Adopting AMI {} without a DeleteOn tag, deleting it on {}".format(
+            image['ImageId'], to_tag[image['ImageId']]['DeleteOn']))
+    tag_images(bucket, to_tag)
+    return len(to_tag)
+
+
 def lambda_handler(event, context):
+    success = 0
     try:
         default_retention = get_environment("retention", 14)
         default_backup_time = get_environment("default_time", 8)
+        max_workers = get_optional_environment("max_workers", DEFAULT_MAX_WORKERS)
+        bucket = throttle.TokenBucket(max(1, get_optional_environment("api_rate", DEFAULT_API_RATE)))
         current_hour = datetime.datetime.now().hour
-        reservations = ec.describe_instances(
-            Filters=[
-                {'Name': 'tag:Backup', 'Values': ['True', 'true']},
-            ]
-        ).get(
-            'Reservations', []
-        )
-
-        instances = sum(
-            [
-                [i for i in r['Instances']]
-                for r in reservations
-                ], [])
-
-        logger.info("Found {} instances that have a backup tag".format(len(instances)))
-
-        to_tag = collections.defaultdict(list)
+        instances = get_instances(current_hour, default_backup_time)
+
+        logger.info("Found {} instances that have a backup tag and can be due at {}h".format(
+            len(instances), current_hour))
+        if not instances:
+            # Nothing is due this hour, which is a success as much as skipping
+            # every instance was before they were filtered server-side
+            success = 100
+
         backedup = 0
         skipped = 0
-        success = 0
+        due = []
         for instance in instances:
             retention = get_tag_value(instance, "Retention", default_retention, str)
             backup_times = get_tag_value(instance, "BackupTimes", default_backup_time, str)
@@ -134,35 +236,39 @@ def lambda_handler(event, context):
                 skipped += 1
                 success = int(float(backedup + skipped) / len(instances) * 100)
                 continue
-            retention_hours = get_retention_for_run(retention, backup_times, current_hour)
-
-            # Create format needs to end with the date because delete_ami is
-            # looking for a backup with current date at the end.
-            create_fmt = datetime.datetime.now().strftime('%H.%M.%S on %Y-%m-%d')
-
-            AMIid = ec.create_image(InstanceId=instance['InstanceId'],
-                                    Name="Lambda - " + instance['InstanceId'] +
-                                    " from " + create_fmt,
-                                    Description="Lambda created AMI of " +
-                                    "instance " + instance['InstanceId'],
-                                    NoReboot=True,
-                                    DryRun=False)
-
-            to_tag[AMIid['ImageId']] = get_tags_for_ami(instance,
-                                                        retention_hours)
-            backedup += 1
-            success = int(float(backedup + skipped) / len(instances) * 100)
-
-            logger.info("Retaining AMI {} of instance {} for {} hours".format(
-                AMIid['ImageId'],
-                instance['InstanceId'],
-                retention_hours,
-            ))
-        for ami in to_tag.keys():
-            ec.create_tags(
-                Resources=[ami],
-                Tags=ansible_dict_to_boto3_tag_list(to_tag[ami]),
-            )
+            due.append((instance, get_retention_for_run(retention, backup_times, current_hour)))
+
+        # The first failure is raised once the other AMIs are created
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = dict(
+                (executor.submit(create_image, bucket, instance, get_tags_for_ami(instance, retention_hours)),
+                 (instance, retention_hours))
+                for instance, retention_hours in due)
+            for future in as_completed(futures):
+                instance, retention_hours = futures[future]
+                try:
+                    AMIid = future.result()
+                except Exception as e:
+                    logger.error("Failed to create an AMI of instance {}: {}".format(instance['InstanceId'], e))
+                    errors.append(e)
+                    continue
+
+                backedup += 1
+                success = int(float(backedup + skipped) / len(instances) * 100)
+
+                logger.info("Retaining AMI {} of instance {} for {} hours".format(
+                    AMIid['ImageId'],
+                    instance['InstanceId'],
+                    retention_hours,
+                ))
+        try:
+            adopt_untagged_images(bucket, convert_retention(str(default_retention)))
+        except Exception as e:
+            # Doesn't hide the errors of creating the AMIs
+            logger.error("Failed to adopt untagged AMIs: {}".format(e))
+        if errors:
+            raise errors[0]
 
     except Exception as e:
         raise e
@@ -1,8 +1,14 @@
 import boto3
 import datetime
+import itertools
 import time
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+import throttle
 
 logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
 logger = logging.getLogger(__name__)
@@ -16,6 +22,37 @@ else:
     ec2_client = boto3.client('ec2')
     ec2_ressource = boto3.resource('ec2')
 
+# Images whose snapshots are looked up by description in one
+# describe_snapshots call, or that are looked up in one describe_images call
+DESCRIBE_SNAPSHOTS_BATCH_SIZE = 100
+DESCRIBE_IMAGES_BATCH_SIZE = 100
+# Descriptions CreateImage gives the snapshots of an AMI
+SNAPSHOT_DESCRIPTION_PATTERN = 'Created by CreateImage(*) for ami-*'
+# Value of the tagname tag create_ami puts on its AMIs and their snapshots
+BACKUP_TAG_VALUE = 'Backup'
+# Images are deleted by this many threads, making up to api_rate calls per
+# second between them
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_API_RATE = 5
+# No image is started once the run has less time left than this, what is
+# left is deleted by the next run. Throttled calls don't back off past it, so
+# it only has to cover the calls in progress.
+TIME_MARGIN_IN_MILLIS = 30000
+# Attempts for each image, a snapshot is often still in use right after its
+# image is deregistered
+MAX_IMAGE_ATTEMPTS = 3
+IMAGE_RETRY_DELAY = 2
+# Errors of images and snapshots that are gone already
+NOT_FOUND_ERROR_CODES = ('InvalidAMIID.NotFound', 'InvalidAMIID.Unavailable', 'InvalidSnapshot.NotFound')
+
+
+def get_int_environment(name, default):
+    try:
+        return int(os.environ.get(name) or default)
+    except ValueError:
+        logger.warning("Environment Parameter {} could not be converted to int! Using {} as a save default!".format(name, default))
+        return default
+
 
 def image_is_broken(image, brokenImages):
     broken = False
@@ -29,6 +66,77 @@ def image_is_broken(image, brokenImages):
     return broken, brokenImages
 
 
+def parse_delete_on(deletion_date):
+    if len(deletion_date.split('-')) == 3:
+        # backups created before the support of hourly backups / can be removed sometime
+        return time.strptime(deletion_date, "%m-%d-%Y")
+    # backups created by the updated function
+    return time.strptime(deletion_date, "%Y-%m-%d-%H")
+
+
+def image_snapshots(image):
+    # The snapshots an image was registered with
+    return [
+        mapping['Ebs']['SnapshotId'] for mapping in image.block_device_mappings or []
+        if 'SnapshotId' in mapping.get('Ebs', {})]
+
+
+def find_snapshots_by_description(images):
+    # Snapshots CreateImage made for images, their description looks like
+    # "Created by CreateImage(i-...) for ami-... from vol-..."
+    snapshotsByImage = dict((image, []) for image in images)
+    for start in range(0, len(images), DESCRIBE_SNAPSHOTS_BATCH_SIZE):
+        batch = images[start:start + DESCRIBE_SNAPSHOTS_BATCH_SIZE]
+        pages = ec2_client.get_paginator('describe_snapshots').paginate(
+            OwnerIds=['self'],
+            Filters=[{'Name': 'description', 'Values': ['* ' + image + ' *' for image in batch]}])
+        for snapshot in itertools.chain.from_iterable(page['Snapshots'] for page in pages):
+            # Image is surrounded with spaces.
+            # Otherwise snapshot of ami-abc and ami-abcd might be both
+            # deleted if we delete ami-abc
+            for word in snapshot['Description'].split(' ')[1:-1]:
+                if word in snapshotsByImage:
+                    snapshotsByImage[word].append(snapshot['SnapshotId'])
+    return snapshotsByImage
+
+
+def find_orphaned_snapshots():
+    # Due snapshots of our AMIs whose AMI is gone, e.g. because a run
+    # deregistered it and then ran out of attempts or time. Only the ones
+    # tagged by create_ami or by delete_image are swept: they carry the backup
+    # marker and the DeleteOn tag of their AMI, or the ones delete_image
+    # leaves on them. Other snapshots of AMIs are never touched.
+    today_date = time.strptime(datetime.datetime.now().strftime('%Y-%m-%d-%H'), '%Y-%m-%d-%H')
+    pages = ec2_client.get_paginator('describe_snapshots').paginate(
+        OwnerIds=['self'],
+        Filters=[
+            {'Name': 'tag:' + os.environ.get('tagname', 'ApplicationRole'), 'Values': [BACKUP_TAG_VALUE]},
+            {'Name': 'tag-key', 'Values': ['DeleteOn']},
+            {'Name': 'description', 'Values': [SNAPSHOT_DESCRIPTION_PATTERN]},
+        ])
+    imageBySnapshot = {}
+    for snapshot in itertools.chain.from_iterable(page['Snapshots'] for page in pages):
+        deletion_date = [t['Value'] for t in snapshot.get('Tags', []) if t['Key'] == 'DeleteOn'][0]
+        try:
+            if parse_delete_on(deletion_date) > today_date:
+                continue
+        except ValueError as e:
+            logger.warning("{}".format(e))
+            continue
+        images = [word for word in snapshot['Description'].split(' ')[1:-1] if word.startswith('ami-')]
+        if images:
+            imageBySnapshot[snapshot['SnapshotId']] = images[0]
+
+    images = sorted(set(imageBySnapshot.values()))
+    existingImages = set()
+    for start in range(0, len(images), DESCRIBE_IMAGES_BATCH_SIZE):
+        pages = ec2_client.get_paginator('describe_images').paginate(
+            Owners=['self'],
+            Filters=[{'Name': 'image-id', 'Values': images[start:start + DESCRIBE_IMAGES_BATCH_SIZE]}])
+        existingImages.update(image['ImageId'] for page in pages for image in page['Images'])
+    return sorted(snapshot for snapshot, image in imageBySnapshot.items() if image not in existingImages)
+
+
 def images_to_delete():
     images = ec2_ressource.images.filter(
         Filters=[
@@ -37,6 +145,7 @@ def images_to_delete():
         Owners=['self']
     )
     imagesList = []
+    snapshotsByImage = {}
     # Set to true once we confirm we have a backup taken today
     backupSuccess = False
     brokenImages = 0
@@ -58,12 +167,7 @@ def images_to_delete():
                     deletion_date = [
                         t.get('Value') for t in image.tags
                         if t['Key'] == 'DeleteOn'][0]
-                    if len(deletion_date.split('-')) == 3:
-                        # backups created before the support of hourly backups / can be removed sometime
-                        delete_date = time.strptime(deletion_date, "%m-%d-%Y")
-                    else:
-                        # backups created by the updated function
-                        delete_date = time.strptime(deletion_date, "%Y-%m-%d-%H")
+                    delete_date = parse_delete_on(deletion_date)
             except IndexError:
                 continue
             except ValueError as e:
@@ -75,6 +179,7 @@ def images_to_delete():
             if delete_date <= today_date:
                 logger.info("Found image {}".format(image.id))
                 imagesList.append(image.id)
+                snapshotsByImage[image.id] = image_snapshots(image)
 
             # Make sure we have an valid AMI from today and mark backupSuccess
             # as true
@@ -84,13 +189,13 @@ def images_to_delete():
                 if not backupSuccess:
                     backupSuccess = True
                     logger.debug("We have at least one backup created on {}".format(date_fmt))
-    return (brokenImages, todayImages, backupSuccess, imagesList)
+    return (brokenImages, todayImages, backupSuccess, imagesList, snapshotsByImage)
 
 
 def lambda_handler(event, context):
 
     # get all our DeleteOn tagged images
-    (brokenImages, todayImages, backupSuccess, imagesList) = images_to_delete()
+    (brokenImages, todayImages, backupSuccess, imagesList, snapshotsByImage) = images_to_delete()
     region = os.environ["region"]
     # DATADOG output
     print('MONITORING|{0}|{1}|count|ami-backup.brokenImages|#region:{2}'
@@ -114,59 +219,151 @@ def lambda_handler(event, context):
             )
 
     # backupSuccess = True  # for testing purpuses, remove once done.
-    deletedImages = delete_images(imagesList, backupSuccess)
+    deletedImages, unfinishedImages = delete_images(imagesList, backupSuccess, snapshotsByImage, context)
     print('MONITORING|{0}|{1}|count|ami-backup.deletedImages|#region:{2}'
           .format(int(time.time()), deletedImages, region))
+    print('MONITORING|{0}|{1}|count|ami-backup.unfinishedImages|#region:{2}'
+          .format(int(time.time()), unfinishedImages, region))
+
+
+def has_time(deadline):
+    return deadline is None or time.time() < deadline
+
+
+def call_unless_gone(bucket, func, deadline, **kwargs):
+    try:
+        throttle.call(bucket, func, deadline=deadline, **kwargs)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in NOT_FOUND_ERROR_CODES:
+            raise
+        logger.info("{} is gone already: {}".format(kwargs.get('ImageId') or kwargs.get('SnapshotId'), e))
+
+
+def delete_orphaned_snapshot(bucket, snapshot, deadline):
+    if not has_time(deadline):
+        return False
+    call_unless_gone(bucket, ec2_client.delete_snapshot, deadline, SnapshotId=snapshot)
+    logger.info("Deleted snapshot {} of a deregistered image".format(snapshot))
+    return True
+
 
+def delete_image(bucket, image, snapshots, deadline):
+    # Deregisters image and deletes its snapshots. A step that fails is tried
+    # again, without repeating the ones that succeeded. Returns False when
+    # the run is out of time, a time.time() deadline, before the image is done.
+    steps = [(ec2_client.deregister_image, {'DryRun': False, 'ImageId': image})]
+    steps.extend((ec2_client.delete_snapshot, {'SnapshotId': snapshot}) for snapshot in snapshots)
 
-def delete_images(imagesList, backupSuccess):
+    def report_left_snapshots():
+        # Once the image is deregistered its snapshots are only found again by
+        # their backup marker and DeleteOn tag, which snapshots of older AMIs
+        # don't have. DeleteOn is set to now, so the next run deletes them.
+        if len(steps) <= len(snapshots):
+            left = [kwargs['SnapshotId'] for _, kwargs in steps]
+            logger.warning("Image {} is deregistered, its snapshots {} are left for the next run".format(
+                image, ', '.join(left)))
+            # May back off into half of the margin, the snapshots are orphaned
+            # without the tag
+            tag_deadline = None if deadline is None else deadline + TIME_MARGIN_IN_MILLIS / 2000.0
+            try:
+                throttle.call(bucket, ec2_client.create_tags, deadline=tag_deadline, Resources=left, Tags=[
+                    {'Key': os.environ.get('tagname', 'ApplicationRole'), 'Value': BACKUP_TAG_VALUE},
+                    {'Key': 'DeleteOn', 'Value': datetime.datetime.now().strftime('%Y-%m-%d-%H')}])
+            except (BotoCoreError, ClientError) as e:
+                logger.error("Failed to tag the snapshots {} of image {} for the next run: {}".format(
+                    ', '.join(left), image, e))
+
+    for attempt in range(MAX_IMAGE_ATTEMPTS):
+        if not has_time(deadline):
+            report_left_snapshots()
+            return False
+        try:
+            while steps:
+                func, kwargs = steps[0]
+                call_unless_gone(bucket, func, deadline, **kwargs)
+                steps.pop(0)
+        except (BotoCoreError, ClientError) as e:
+            if attempt == MAX_IMAGE_ATTEMPTS - 1:
+                report_left_snapshots()
+                raise
+            delay = IMAGE_RETRY_DELAY * 2 ** attempt
+            logger.warning("Failed to delete image {} ({}), trying again in {} seconds".format(image, e, delay))
+            time.sleep(delay)
+            continue
+        logger.info("Deregistered image {} and deleted snapshots {}".format(image, ', '.join(snapshots) or '-'))
+        return True
+
+
+def delete_images(imagesList, backupSuccess, snapshotsByImage=None, context=None):
+    # Returns how many images were deleted and how many are left for the
+    # next run. Snapshots earlier runs left behind are deleted first.
     deletedImages = 0
+    unfinished = []
     if backupSuccess is True:
 
         logger.info("=============")
         logger.info("About to process the following AMIs:")
         logger.info(', '.join(imagesList))
 
-        snapshots = []
-        tmp = ec2_client.describe_snapshots(MaxResults=1000, OwnerIds=['self'])
-
-        while True:
-            snapshots.extend(tmp["Snapshots"])
-            if "NextToken" not in tmp:
-                break
-            logger.info("Need to describe snapshots once again, we hit result limit")
-            token = tmp["NextToken"]
-            tmp = ec2_client.describe_snapshots(
-                MaxResults=1000,
-                OwnerIds=['self'],
-                NextToken=token
-            )
+        # Images without snapshots in their block device mappings are looked up
+        # by snapshot description instead
+        snapshotsByImage = dict(snapshotsByImage or {})
+        unmapped = [image for image in imagesList if not snapshotsByImage.get(image)]
+        if unmapped:
+            logger.info("Looking up the snapshots of {} AMIs by description".format(len(unmapped)))
+            snapshotsByImage.update(find_snapshots_by_description(unmapped))
 
-        # loop through list of image IDs
-        for image in imagesList:
-            logger.info("deregistering image {}".format(image))
-            ec2_client.deregister_image(
-                DryRun=False,
-                ImageId=image,
-            )
+        orphanedSnapshots = find_orphaned_snapshots()
+        if orphanedSnapshots:
+            logger.info("Deleting {} snapshots of deregistered AMIs: {}".format(
+                len(orphanedSnapshots), ', '.join(orphanedSnapshots)))
+
+        deadline = None
+        remaining_time_in_millis = getattr(context, 'get_remaining_time_in_millis', None)
+        if remaining_time_in_millis is not None:
+            deadline = time.time() + (remaining_time_in_millis() - TIME_MARGIN_IN_MILLIS) / 1000.0
+
+        bucket = throttle.TokenBucket(max(1, get_int_environment("api_rate", DEFAULT_API_RATE)))
+        max_workers = max(1, get_int_environment("max_workers", DEFAULT_MAX_WORKERS))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            snapshotFutures = dict(
+                (executor.submit(delete_orphaned_snapshot, bucket, snapshot, deadline), snapshot)
+                for snapshot in orphanedSnapshots)
+            futures = dict(
+                (executor.submit(delete_image, bucket, image, snapshotsByImage.get(image, []), deadline), image)
+                for image in imagesList)
+            for future in as_completed(futures):
+                image = futures[future]
+                try:
+                    deleted = future.result()
+                except Exception as e:
+                    logger.error("Failed to delete image {}: {}".format(image, e))
+                    deleted = False
+                if deleted:
+                    deletedImages += 1
+                else:
+                    unfinished.append(image)
+            leftSnapshots = 0
+            for future in as_completed(snapshotFutures):
+                try:
+                    leftSnapshots += not future.result()
+                except Exception as e:
+                    logger.error("Failed to delete snapshot {}: {}".format(snapshotFutures[future], e))
+                    leftSnapshots += 1
 
-            for snapshot in snapshots:
-                # Image is surrounded with spaces.
-                # Otherwise snapshot of ami-abc and ami-abcd might be both
-                # deleted if we delete ami-abc
-                if snapshot['Description'].find(' ' + image + ' ') > 0:
-                    ec2_client.delete_snapshot(
-                        SnapshotId=snapshot['SnapshotId']
-                    )
-                    logger.info("Deleting snapshot {}".format(snapshot['SnapshotId']))
+        if leftSnapshots:
+            logger.warning("Left {} of {} snapshots of deregistered AMIs for the next run".format(
+                leftSnapshots, len(orphanedSnapshots)))
 
-            logger.info("-------------")
-            deletedImages += 1
+        if unfinished:
+            logger.warning("Left {} of {} AMIs for the next run: {}".format(
+                len(unfinished), len(imagesList), ', '.join(sorted(unfinished))))
+        logger.info("-------------")
 
     else:
         logger.info("No current backup found. Termination suspended.")
 
-    return deletedImages
+    return deletedImages, len(unfinished)
 
 
 # Enable local debugging
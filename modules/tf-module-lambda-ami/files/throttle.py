@@ -0,0 +1,83 @@
+import logging
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Error codes of EC2 and the other APIs when the account's request rate is
+# exceeded
+THROTTLING_ERROR_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+
+
+def is_throttling_error(error):
+    return isinstance(error, ClientError) and \
+        error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+class TokenBucket(object):
+    # Lets callers from any thread make up to `rate` API calls per second on
+    # average and `burst` at once. The rate is halved every time the API
+    # throttles a call and grows back by a tenth of the configured rate with
+    # every call that goes through, so the callers settle just below the rate
+    # the account is allowed.
+
+    def __init__(self, rate, burst=None, min_rate=0.5):
+        if rate <= 0:
+            raise ValueError("The rate of a TokenBucket must be positive, not {}".format(rate))
+        self._max_rate = float(rate)
+        self._min_rate = min(float(min_rate), self._max_rate)
+        self._rate = self._max_rate
+        self._burst = float(burst or rate)
+        self._tokens = self._burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Blocks until a call can be made
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            self._rate = max(self._min_rate, self._rate / 2)
+            self._tokens = min(self._tokens, 0)
+            logger.info("Throttled, making up to {:.1f} calls per second".format(self._rate))
+
+    def succeeded(self):
+        with self._lock:
+            self._rate = min(self._max_rate, self._rate + self._max_rate / 10)
+
+
+def call(bucket, func, max_attempts=6, base_delay=1, max_delay=30, deadline=None, **kwargs):
+    # Calls func(**kwargs) at the bucket's rate. Calls that are throttled are
+    # tried again after a jittered exponential backoff, other errors are raised
+    # right away. The throttling error is raised too when the backoff would
+    # end past deadline, a time.time().
+    for attempt in range(max_attempts):
+        bucket.acquire()
+        try:
+            result = func(**kwargs)
+        except ClientError as e:
+            if not is_throttling_error(e) or attempt == max_attempts - 1:
+                raise
+            bucket.throttled()
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            if deadline is not None and time.time() + delay > deadline:
+                raise
+            logger.warning("{} was throttled, trying again in {:.1f} seconds".format(e.operation_name, delay))
+            time.sleep(delay)
+            continue
+        bucket.succeeded()
+        return result
@@ -24,14 +24,32 @@ resource "aws_cloudwatch_event_rule" "stop_event" {
 
 data "archive_file" "create-ami-archive" {
   type        = "zip"
-  source_file = "${path.module}/files/create_ami.py"
   output_path = "${path.module}/files/create_ami.zip"
+
+  source {
+    content  = "${file("${path.module}/files/create_ami.py")}"
+    filename = "create_ami.py"
+  }
+
+  source {
+    content  = "${file("${path.module}/files/throttle.py")}"
+    filename = "throttle.py"
+  }
 }
 
 data "archive_file" "delete-ami-archive" {
   type        = "zip"
-  source_file = "${path.module}/files/delete_ami.py"
   output_path = "${path.module}/files/delete_ami.zip"
+
+  source {
+    content  = "${file("${path.module}/files/delete_ami.py")}"
+    filename = "delete_ami.py"
+  }
+
+  source {
+    content  = "${file("${path.module}/files/throttle.py")}"
+    filename = "throttle.py"
+  }
 }
 
 resource "aws_lambda_function" "create_ami" {
@@ -50,6 +68,8 @@ resource "aws_lambda_function" "create_ami" {
       retention    = "${var.ami_retention_time}"
       tagname      = "${var.tag_name}"
       default_time = "${var.cw_start_time}"
+      max_workers  = "${var.create_ami_workers}"
+      api_rate     = "${var.create_ami_api_rate}"
     }
   }
 
@@ -68,8 +88,11 @@ resource "aws_lambda_function" "delete_ami" {
 
   environment {
     variables = {
-      region    = "${var.region}"
-      sns_topic = "${var.sns_topic}"
+      region      = "${var.region}"
+      tagname     = "${var.tag_name}"
+      sns_topic   = "${var.sns_topic}"
+      max_workers = "${var.delete_ami_workers}"
+      api_rate    = "${var.delete_ami_api_rate}"
     }
   }
 
@@ -165,7 +188,8 @@ resource "aws_iam_policy" "delete" {
       "Action": [
         "ec2:Describe*",
         "ec2:DeregisterImage",
-        "ec2:DeleteSnapshot"
+        "ec2:DeleteSnapshot",
+        "ec2:CreateTags"
       ],
       "Resource": "*"
     }
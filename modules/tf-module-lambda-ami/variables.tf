@@ -44,11 +44,31 @@ variable "create_ami_timeout" {
   default     = "300"
 }
 
+variable "create_ami_workers" {
+  description = "How many AMIs the lambda CREATE creates at once"
+  default     = "8"
+}
+
+variable "create_ami_api_rate" {
+  description = "The EC2 API calls per second the lambda CREATE makes at most. It slows down further when EC2 throttles it."
+  default     = "5"
+}
+
 variable "delete_ami_timeout" {
   description = "The lambda DELETE timeout"
   default     = "300"
 }
 
+variable "delete_ami_workers" {
+  description = "How many AMIs the lambda DELETE deregisters and deletes the snapshots of at once"
+  default     = "8"
+}
+
+variable "delete_ami_api_rate" {
+  description = "The EC2 API calls per second the lambda DELETE makes at most. It slows down further when EC2 throttles it."
+  default     = "5"
+}
+
 variable "sns_topic" {
   description = "The arn of the sns topic to publish problems to"
   default     = ""
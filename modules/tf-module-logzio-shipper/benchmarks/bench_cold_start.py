@@ -0,0 +1,145 @@
+# Benchmarks the cold start of the Logz.io shipper.
+#
+# Every run starts a fresh interpreter, like a new Lambda container, that
+# imports lambda_function and invokes lambda_handler once against a local
+# stand-in of the Logz.io listener. It reports how long the import took, which
+# the Lambda init phase pays, and how long the first invocation took until the
+# listener received the first bulk.
+#
+# Run it with the interpreter of the Lambda runtime, e.g.:
+#   python benchmarks/bench_cold_start.py --runs 20 --compress false,true
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench_shipper import FILES_DIR, ListenerStandIn, _ListenerHandler, build_event
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# What runs in every fresh interpreter. Nothing but time and sys is imported
+# before lambda_function. time.time() is shared with the listener of this
+# process.
+COLD_START = """
+import sys
+import time
+start = time.time()
+sys.path.insert(0, sys.argv[1])
+import lambda_function
+imported = time.time()
+
+import json
+import logging
+import os
+sys.path.insert(0, sys.argv[2])
+from bench_shipper import LambdaContextStandIn
+logging.getLogger().setLevel(logging.WARNING)
+with open(sys.argv[3]) as event_file:
+    event = json.load(event_file)
+
+invoked_at = time.time()
+lambda_function.lambda_handler(event, LambdaContextStandIn())
+print(json.dumps({
+    'import_seconds': imported - start,
+    'invoked_at': invoked_at,
+    'invocation_seconds': time.time() - invoked_at,
+}))
+sys.stdout.flush()
+# Don't wait for the daemon sender threads
+os._exit(0)
+"""
+
+
+class FirstBulkListener(ListenerStandIn):
+    # Remembers when the first bulk of a run arrived
+
+    def __init__(self):
+        ListenerStandIn.__init__(self)
+        self.RequestHandlerClass = _FirstBulkHandler
+        self.first_bulk_at = None
+
+    def reset(self):
+        with self.lock:
+            self.first_bulk_at = None
+
+
+class _FirstBulkHandler(_ListenerHandler):
+
+    def do_POST(self):
+        with self.server.lock:
+            if self.server.first_bulk_at is None:
+                self.server.first_bulk_at = time.time()
+        _ListenerHandler.do_POST(self)
+
+
+def _spawn(options, listener, compress, event_path):
+    environ = dict(os.environ, URL=listener.url, TOKEN='benchmark', TYPE='benchmark',
+                   FORMAT=options.format, COMPRESS=compress, METRICS_NAMESPACE='')
+    command = [sys.executable, '-c', COLD_START, FILES_DIR, BENCHMARKS_DIR, event_path]
+    listener.reset()
+    spawned_at = time.time()
+    output = subprocess.check_output(command, env=environ)
+    finished_at = time.time()
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    result['first_byte_seconds'] = listener.first_bulk_at - result['invoked_at']
+    result['process_seconds'] = finished_at - spawned_at
+    return result
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the cold start of the Logz.io shipper Lambda")
+    parser.add_argument('--runs', type=int, default=10, help="fresh interpreters per scenario")
+    parser.add_argument('--events', type=int, default=100, help="log events of the first invocation")
+    parser.add_argument('--message-size', type=int, default=200, help="approximate size of a message")
+    parser.add_argument('--group', default='lambda', help="lambda or other")
+    parser.add_argument('--format', default='text', help="FORMAT value: json or text")
+    parser.add_argument('--compress', default='false,true', help="comma separated COMPRESS values")
+    parser.add_argument('--json', action='store_true', help="print the results as json")
+    options = parser.parse_args(argv)
+
+    event, _ = build_event(options.events, options.message_size, options.group, options.format)
+    event_file = tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False)
+    with event_file:
+        json.dump(event, event_file)
+
+    listener = FirstBulkListener()
+    server_thread = threading.Thread(target=listener.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    results = []
+    try:
+        for compress in options.compress.split(','):
+            results.append(_run_scenario(options, listener, compress, event_file.name))
+    finally:
+        os.remove(event_file.name)
+
+    if options.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+def _run_scenario(options, listener, compress, event_path):
+    runs = [_spawn(options, listener, compress, event_path) for _ in range(options.runs)]
+    result = dict((measure, _median([run[measure] for run in runs]))
+                  for measure in ('import_seconds', 'first_byte_seconds', 'invocation_seconds', 'process_seconds'))
+    result.update(compress=compress, runs=options.runs, events=options.events)
+    if not options.json:
+        print("compress={compress:5} median of {runs} cold starts: import {imp:.1f} ms, first byte after "
+              "{first:.1f} ms, invocation {inv:.1f} ms, whole process {proc:.1f} ms".format(
+                  compress=compress, runs=options.runs, imp=result['import_seconds'] * 1000,
+                  first=result['first_byte_seconds'] * 1000, inv=result['invocation_seconds'] * 1000,
+                  proc=result['process_seconds'] * 1000))
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+# Benchmarks the Logz.io shipper end to end.
+#
+# Generates a synthetic awslogs event, runs lambda_function.lambda_handler
+# against a local stand-in of the Logz.io listener and reports throughput, peak
+# memory and the time spent in every stage of the pipeline. Every scenario runs
+# in its own process so that peak memory isn't shared between them.
+#
+# Run it with the interpreter of the Lambda runtime, e.g.:
+#   python benchmarks/bench_shipper.py --events 20000 --group lambda,other \
+#       --format json,text --compress true,false
+#
+# --engine asyncio benchmarks the asyncio engine, which needs Python 3.
+import argparse
+import base64
+import collections
+import gzip
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import timeit
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files')
+LOG_GROUPS = {'lambda': '/aws/lambda/benchmark', 'other': '/benchmark/application'}
+STAGES = ('decode', 'parse', 'serialize', 'compress', 'send')
+WORDS = ('request', 'user', 'cache', 'timeout', 'retry', 'session', 'query', 'token', 'worker', 'queue')
+
+timer = timeit.default_timer
+
+
+class ListenerStandIn(ThreadingMixIn, HTTPServer):
+    # Accepts bulks like the Logz.io listener and counts what it received
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _ListenerHandler)
+        self.lock = threading.Lock()
+        self.bulks = 0
+        self.bytes_received = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+class _ListenerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        with self.server.lock:
+            self.server.bulks += 1
+            self.server.bytes_received += length
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class LambdaContextStandIn(object):
+    function_version = '$LATEST'
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return 300000
+
+
+def _message(rnd, index, log_format, message_size):
+    text = ' '.join(rnd.choice(WORDS) for _ in range(max(1, message_size // 7)))[:message_size]
+    if log_format == 'json':
+        return json.dumps({'event': index, 'level': rnd.choice(('debug', 'info', 'warn')), 'text': text})
+    return "event {} {}".format(index, text)
+
+
+def build_event(events, message_size, group, log_format, seed=1):
+    # type: (int, int, str, str, int) -> (dict, int)
+    rnd = random.Random(seed)
+    log_events = []
+    for index in range(events):
+        message = _message(rnd, index, log_format, message_size)
+        if group == 'lambda':
+            message = "[INFO]\t2017-04-26T10:41:09.023Z\tdb95c6da-2a6c-11e7-9550-c91b65931beb\t{}\n".format(message)
+        log_events.append({'id': str(index), 'timestamp': 1493203269023 + index, 'message': message})
+
+    payload = json.dumps({
+        'messageType': 'DATA_MESSAGE',
+        'owner': '123456789012',
+        'logGroup': LOG_GROUPS[group],
+        'logStream': '2017/04/26/[$LATEST]benchmark',
+        'subscriptionFilters': ['benchmark'],
+        'logEvents': log_events,
+    }).encode('utf-8')
+    compressed = io.BytesIO()
+    writer = gzip.GzipFile(fileobj=compressed, mode='wb')
+    writer.write(payload)
+    writer.close()
+    return {'awslogs': {'data': base64.b64encode(compressed.getvalue()).decode('ascii')}}, len(payload)
+
+
+class StageTimers(object):
+    # Wraps the functions of the pipeline to add up the time spent in each stage
+
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.seconds[stage] += seconds
+
+    def wrap(self, owner, name, stage):
+        func = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            start = timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, timer() - start)
+        setattr(owner, name, timed)
+
+    def wrap_future(self, owner, name, stage):
+        # For functions that return a future, times them until it is done
+        func = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            start = timer()
+            future = func(*args, **kwargs)
+            future.add_done_callback(lambda _: self.add(stage, timer() - start))
+            return future
+        setattr(owner, name, timed)
+
+    def wrap_generator(self, owner, name, stage):
+        func = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            iterator = iter(func(*args, **kwargs))
+            while True:
+                start = timer()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    self.add(stage, timer() - start)
+                    return
+                self.add(stage, timer() - start)
+                yield item
+        setattr(owner, name, timed)
+
+    def install(self, engine):
+        import aws_logs
+        import lambda_function
+        import shipper
+
+        self.wrap(lambda_function, '_extract_aws_logs_data', 'decode')
+        self.wrap_generator(aws_logs.AwsLogsReader, 'log_events', 'decode')
+        self.wrap(lambda_function, '_parse_cloudwatch_log', 'parse')
+        # add_record() serializes and writes to the request, _send_to_logzio() closes
+        # the request and sends it. The request methods are timed on their own
+        # and taken out of both again in stages().
+        self.wrap(shipper.LogzioShipper, 'add_record', 'add')
+        if engine == 'asyncio':
+            # The bulks are sent by coroutines, timed from the moment they are
+            # handed to the event loop
+            import async_shipper
+            self.wrap_future(async_shipper.LogzioShipper, '_submit', 'send_bulk')
+        else:
+            self.wrap(shipper.LogzioShipper, '_send_to_logzio', 'send_bulk')
+        for request in (shipper.GzipLogRequest, shipper.StringLogRequest):
+            self.wrap(request, 'fits', 'request_write')
+            self.wrap(request, 'write', 'request_write')
+            self.wrap(request, 'flush', 'request_close')
+            self.wrap(request, 'close', 'request_close')
+
+    def stages(self):
+        # send is the time spent on the sender threads, it overlaps the others
+        seconds = self.seconds
+        return {
+            'decode': seconds['decode'],
+            'parse': seconds['parse'],
+            'serialize': max(0.0, seconds['add'] - seconds['request_write']),
+            'compress': seconds['request_write'] + seconds['request_close'],
+            'send': max(0.0, seconds['send_bulk'] - seconds['request_close']),
+        }
+
+
+def run_scenario(options):
+    # Runs inside the scenario's own process and returns its measurements
+    sys.path.insert(0, FILES_DIR)
+    listener = ListenerStandIn()
+    server_thread = threading.Thread(target=listener.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    os.environ.update({
+        'URL': listener.url,
+        'TOKEN': 'benchmark',
+        'TYPE': 'benchmark',
+        'FORMAT': options.format,
+        'COMPRESS': options.compress,
+        'ENGINE': options.engine,
+    })
+    import lambda_function
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    timers = None
+    if options.instrument:
+        timers = StageTimers()
+        timers.install(options.engine)
+
+    event, payload_size = build_event(options.events, options.message_size, options.group, options.format)
+    context = LambdaContextStandIn()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    durations = []
+    for _ in range(options.invocations):
+        start = timer()
+        lambda_function.lambda_handler(event, context)
+        durations.append(timer() - start)
+
+    result = {
+        'events': options.events,
+        'payload_bytes': payload_size,
+        'invocations': options.invocations,
+        'best_seconds': min(durations),
+        'median_seconds': sorted(durations)[len(durations) // 2],
+        'bulks': listener.bulks // options.invocations,
+        'bytes_sent': listener.bytes_received // options.invocations,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_rss_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+    }
+    if timers:
+        result['stages'] = dict((stage, seconds / options.invocations) for stage, seconds in timers.stages().items())
+    return result
+
+
+def _spawn(options, group, log_format, compress, stages):
+    command = [sys.executable, os.path.abspath(__file__), '--run-scenario',
+               '--events', str(options.events),
+               '--message-size', str(options.message_size),
+               '--invocations', str(options.invocations),
+               '--group', group, '--format', log_format, '--compress', compress,
+               '--engine', options.engine]
+    if stages:
+        command.append('--instrument')
+    output = subprocess.check_output(command)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def _report(scenario, result):
+    seconds = result['best_seconds']
+    print("{group:6} {format:4} compress={compress:5} {events} events in {seconds:.3f}s: "
+          "{eps:,.0f} events/s, {mbps:.1f} MB/s in, {bulks} bulks, {sent:,} bytes sent, "
+          "peak rss {rss:,} KB (+{growth:,} KB)".format(
+              group=scenario[0], format=scenario[1], compress=scenario[2], events=result['events'],
+              seconds=seconds, eps=result['events'] / seconds,
+              mbps=result['payload_bytes'] / seconds / 1024 / 1024,
+              bulks=result['bulks'], sent=result['bytes_sent'],
+              rss=result['peak_rss_kb'], growth=result['peak_rss_growth_kb']))
+    if 'stages' in result:
+        print("    " + ", ".join("{} {:.3f}s".format(stage, result['stages'][stage]) for stage in STAGES))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Logz.io shipper Lambda end to end")
+    parser.add_argument('--events', type=int, default=10000, help="log events per invocation")
+    parser.add_argument('--message-size', type=int, default=200, help="approximate size of a message")
+    parser.add_argument('--invocations', type=int, default=3, help="warm invocations per scenario")
+    parser.add_argument('--group', default='lambda,other', help="comma separated: lambda, other")
+    parser.add_argument('--format', default='json,text', help="comma separated FORMAT values: json, text")
+    parser.add_argument('--compress', default='false,true', help="comma separated COMPRESS values")
+    parser.add_argument('--engine', default='threads', help="ENGINE value: threads or asyncio")
+    parser.add_argument('--no-stages', dest='stages', action='store_false',
+                        help="skip the second, instrumented run that measures per stage timings")
+    parser.add_argument('--json', action='store_true', help="print the results as json")
+    parser.add_argument('--run-scenario', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--instrument', action='store_true', help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+
+    if options.run_scenario:
+        print(json.dumps(run_scenario(options)))
+        sys.stdout.flush()
+        # Don't wait for the daemon sender threads
+        os._exit(0)
+
+    results = []
+    for scenario in itertools.product(options.group.split(','), options.format.split(','),
+                                      options.compress.split(',')):
+        result = _spawn(options, *scenario, stages=False)
+        if options.stages:
+            # Timing every call slows the pipeline down, so the stage timings
+            # come from a separate run and only their proportions matter
+            result['stages'] = _spawn(options, *scenario, stages=True)['stages']
+        results.append(dict(result, group=scenario[0], format=scenario[1], compress=scenario[2]))
+        if not options.json:
+            _report(scenario, result)
+
+    if options.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
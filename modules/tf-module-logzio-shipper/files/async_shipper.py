@@ -0,0 +1,256 @@
+import asyncio
+import http.client
+import io
+import logging
+import socket
+import ssl
+import threading
+import urllib.error
+import urllib.parse
+
+import shipper
+from connection_pool import ConnectionPool
+from metrics import timer
+# The exceptions are the ones the threads' shipper raises
+from shipper import MaxRetriesException, BadLogsException, UnauthorizedAccessException, UnknownURL
+from shipper import MAX_RETRIES, _ensure_workers, _get_attempt_timeout, _get_backoff, _handle_http_error, \
+    _has_time_for, _is_timeout
+
+logger = logging.getLogger()
+
+# Errors raised when a kept-alive connection was closed by the server
+CONNECTION_ERRORS = (http.client.HTTPException, OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError)
+# Responses that never have a body, whatever their headers say
+NO_BODY_STATUS_CODES = (204, 304)
+
+# The event loop that sends the bulks runs on its own thread, it and its
+# connections are kept across warm invocations
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='logzio-event-loop')
+            thread.daemon = True
+            thread.start()
+            _loop = loop
+    return _loop
+
+
+def _run(coroutine):
+    # type: (Coroutine) -> concurrent.futures.Future
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_loop())
+
+
+class AsyncConnectionPool(object):
+    # Keep-alive HTTP/1.1 connections over asyncio streams. All of its methods
+    # run on the event loop thread, so it doesn't need a lock.
+
+    def __init__(self, max_idle_connections=8):
+        self._max_idle_connections = max_idle_connections
+        self._idle_connections = {}
+        self._ssl_context = None
+
+    async def request(self, method, url, body, headers, timeout=None):
+        # type: (str, str, Iterable[bytes], dict, Optional[float]) -> (int, str, http.client.HTTPMessage, bytes)
+        # Same as ConnectionPool.request, the body's chunks are written as they
+        # are and the socket is drained after each one. timeout bounds the whole
+        # request, connecting included, asyncio.TimeoutError is raised when the
+        # listener stalls.
+        return await asyncio.wait_for(self._request(method, url, body, headers), timeout)
+
+    async def _request(self, method, url, body, headers):
+        if isinstance(body, bytes):
+            body = (body,)
+        key, path = ConnectionPool._split_url(url)
+
+        connection = self._get_idle_connection(key)
+        if connection is not None:
+            try:
+                return await self._do_request(key, connection, method, path, body, headers)
+            except CONNECTION_ERRORS as e:
+                logger.info("Kept-alive connection to {} was closed ({!r}), reconnecting".format(key[1], e))
+
+        return await self._do_request(key, await self._connect(key), method, path, body, headers)
+
+    async def open_connection(self, url, timeout=None):
+        # type: (str, Optional[float]) -> None
+        key, _ = ConnectionPool._split_url(url)
+        self._release_connection(key, await asyncio.wait_for(self._connect(key), timeout))
+
+    async def _do_request(self, key, connection, method, path, body, headers):
+        reader, writer = connection
+        try:
+            head = ["{} {} HTTP/1.1".format(method, path)]
+            if 'Host' not in headers:
+                head.append("Host: {}".format(key[1]))
+            head.extend("{}: {}".format(header, value) for header, value in headers.items())
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1'))
+            for chunk in body:
+                writer.write(chunk)
+                await writer.drain()
+            status, reason, response_headers = await self._read_response_head(reader)
+            while status < 200:
+                # Interim responses have no body, the final one follows them
+                status, reason, response_headers = await self._read_response_head(reader)
+            response_body, will_close = await self._read_response_body(reader, status, response_headers)
+        except CONNECTION_ERRORS + (asyncio.CancelledError,):
+            # Also closed when the request times out, what is left of the
+            # response would be read by the next request otherwise
+            writer.close()
+            raise
+
+        if will_close or (response_headers.get('Connection') or '').lower() == 'close':
+            writer.close()
+        else:
+            self._release_connection(key, connection)
+        return status, reason, response_headers, response_body
+
+    @staticmethod
+    async def _read_response_head(reader):
+        head = await reader.readuntil(b"\r\n\r\n")
+        status_line, _, header_lines = head.partition(b"\r\n")
+        try:
+            version, status, reason = (status_line.decode('latin-1').split(None, 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(status_line)
+        return status, reason, http.client.parse_headers(io.BytesIO(header_lines))
+
+    @staticmethod
+    async def _read_response_body(reader, status, headers):
+        # Returns the body and whether the connection can't be reused
+        if status in NO_BODY_STATUS_CODES:
+            return b'', False
+        if 'chunked' in (headers.get('Transfer-Encoding') or '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if not size:
+                    # Trailers end with an empty line too
+                    while await reader.readuntil(b"\r\n") != b"\r\n":
+                        pass
+                    return b''.join(chunks), False
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+        content_length = headers.get('Content-Length')
+        if content_length is not None:
+            return await reader.readexactly(int(content_length)), False
+        return await reader.read(), True
+
+    def _get_idle_connection(self, key):
+        connections = self._idle_connections.get(key)
+        return connections.pop() if connections else None
+
+    def _release_connection(self, key, connection):
+        connections = self._idle_connections.setdefault(key, [])
+        if len(connections) < self._max_idle_connections:
+            connections.append(connection)
+        else:
+            connection[1].close()
+
+    async def _connect(self, key):
+        scheme, netloc = key
+        split_netloc = urllib.parse.urlsplit('//' + netloc)
+        ssl_context = None
+        if scheme == 'https':
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            ssl_context = self._ssl_context
+        port = split_netloc.port or (443 if scheme == 'https' else 80)
+        return await asyncio.open_connection(split_netloc.hostname, port, ssl=ssl_context)
+
+
+_connection_pool = AsyncConnectionPool()
+
+
+class LogzioShipper(shipper.LogzioShipper):
+    # The shipper with its bulks sent by coroutines on an event loop instead of
+    # the sender threads. add() and flush() stay synchronous: the caller keeps
+    # decoding, parsing and serializing the next bulk while the loop writes the
+    # ones in flight to non-blocking sockets, and waits only once
+    # max_bulks_in_flight bulks are queued. Needs Python 3.
+
+    def _start_workers(self, compress, compress_workers):
+        _ensure_workers(0, compress, compress_workers)
+        _get_loop()
+
+    def _submit(self, logs, bulk):
+        return _run(self._send_to_logzio_async(logs, bulk))
+
+    def _post(self, logs, timeout=None):
+        # Blocks the calling thread, e.g. while sending spilled bulks
+        return _run(self._post_async(logs, timeout)).result()
+
+    async def _post_async(self, logs, timeout=None):
+        if timeout is None:
+            timeout = _get_attempt_timeout(self._remaining_time_in_millis)
+        if self._compress:
+            # Waits for the compressor threads without blocking the loop
+            await asyncio.get_event_loop().run_in_executor(None, logs.close)
+        else:
+            logs.close()
+        headers = dict(logs.http_headers())
+        headers['Content-Length'] = str(logs.compress_size())
+        start = timer()
+        try:
+            status, reason, response_headers, body = await _connection_pool.request(
+                'POST', self._logzio_url, logs, headers, timeout)
+        except asyncio.TimeoutError:
+            # The same error as a socket timeout of the threads' shipper
+            raise urllib.error.URLError(socket.timeout('timed out'))
+        except CONNECTION_ERRORS as e:
+            raise urllib.error.URLError(e)
+        finally:
+            if self._metrics is not None:
+                self._metrics.add_latency(timer() - start)
+        if status >= 400:
+            raise urllib.error.HTTPError(self._logzio_url, status, reason, response_headers, None)
+        return body
+
+    async def _retry(self, logs):
+        # LogzioShipper.retry, sleeping on the loop
+        retry_after = 0
+        for retries in range(MAX_RETRIES):
+            if retries:
+                sleep_between_retries = _get_backoff(retries, retry_after)
+                if not _has_time_for(sleep_between_retries, self._remaining_time_in_millis):
+                    break
+                logger.info("Failure in sending logs - Trying again in {:.1f} seconds".format(sleep_between_retries))
+                await asyncio.sleep(sleep_between_retries)
+                if self._metrics is not None:
+                    self._metrics.add('Retries', 1)
+            try:
+                return await self._post_async(logs)
+            except urllib.error.HTTPError as e:
+                retry_after = _handle_http_error(e, self._shrink_bulks)
+            except urllib.error.URLError as e:
+                if not _is_timeout(e):
+                    raise
+                logger.warning("Logz.io didn't answer in time: {}".format(e))
+        raise MaxRetriesException()
+
+    async def _send_to_logzio_async(self, logs, bulk):
+        try:
+            await self._retry(logs)
+        except Exception as e:
+            if self._handle_failure(logs, bulk, e):
+                return
+            raise
+        self._handle_success(logs)
+
+
+def prepare(logzio_url, max_bulks_in_flight=LogzioShipper.MAX_BULKS_IN_FLIGHT, compress=False, compress_workers=0,
+            connect_timeout=2):
+    # type: (str, int, bool, int, float) -> None
+    # Starts the event loop and the compressor threads and opens a connection
+    # to the listener ahead of the first shipper
+    _ensure_workers(0, compress, compress_workers)
+    try:
+        _run(_connection_pool.open_connection(logzio_url, connect_timeout)).result()
+    except CONNECTION_ERRORS + (asyncio.TimeoutError,) as e:
+        logger.info("Failed to connect to Logz.io ahead of time: {!r}".format(e))
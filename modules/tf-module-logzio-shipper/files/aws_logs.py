@@ -0,0 +1,150 @@
+import base64
+import codecs
+import json
+import zlib
+
+# Base64 is decoded in slices of this many characters. It has to be a multiple
+# of 4 so that every slice decodes on its own.
+BASE64_CHUNK_SIZE = 64 * 1024
+# Upper bound of decompressed bytes produced per read
+READ_SIZE = 64 * 1024
+
+_WHITESPACE = u' \t\n\r'
+
+
+class AwsLogsReader(object):
+    # Streams a CloudWatch Logs subscription payload (base64 encoded, gzipped
+    # json) without materializing it. The top level fields are available in
+    # `header` as soon as the reader is built and `log_events()` yields the
+    # logEvents one by one, so only a small window of the decompressed payload
+    # is kept in memory at any time.
+
+    def __init__(self, data, header_fields=()):
+        # type: (str, tuple) -> None
+        self._data = data
+        self._offset = 0
+        self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = u''
+        self._position = 0
+        self._eof = False
+        self._events_pending = False
+        self.header = {}
+        self._read_header()
+
+        # CloudWatch always writes the logEvents last. If it didn't, buffer the
+        # events so the caller gets the full header before the first event.
+        self._buffered_events = None
+        if self._events_pending and any(field not in self.header for field in header_fields):
+            self._buffered_events = list(self._iter_log_events())
+
+    def log_events(self):
+        # type: () -> Iterator[dict]
+        if self._buffered_events is not None:
+            events, self._buffered_events = self._buffered_events, []
+            return iter(events)
+        return self._iter_log_events()
+
+    def _iter_log_events(self):
+        if not self._events_pending:
+            return
+        self._events_pending = False
+
+        if self._peek() == u']':
+            self._position += 1
+        else:
+            while True:
+                yield self._read_value()
+                if self._expect(u',]') == u']':
+                    break
+
+        while self._expect(u',}') == u',':
+            self._read_member()
+
+    def _read_header(self):
+        self._expect(u'{')
+        if self._peek() == u'}':
+            self._position += 1
+            return
+
+        while True:
+            if self._read_member():
+                return
+            if self._expect(u',}') == u'}':
+                return
+
+    def _read_member(self):
+        # Reads one "key": value pair. Stops in front of the first logEvent
+        # and returns True when it reached the logEvents array.
+        key = self._read_value()
+        self._expect(u':')
+        if key == 'logEvents':
+            self._expect(u'[')
+            self._events_pending = True
+            return True
+        self.header[key] = self._read_value()
+        return False
+
+    def _read_value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._position)
+            except ValueError:
+                value, end = None, None
+            # A value is complete only once something follows it, a number at
+            # the end of the buffer may continue in the next chunk.
+            if end is not None and end < len(self._buffer):
+                self._position = end
+                return value
+            if not self._fill():
+                if end is None:
+                    raise ValueError("Truncated or malformed awslogs data at offset {}".format(self._position))
+                self._position = end
+                return value
+
+    def _expect(self, expected):
+        char = self._peek()
+        if not char or char not in expected:
+            raise ValueError("Expected one of '{}' in awslogs data but found '{}'".format(expected, char))
+        self._position += 1
+        return char
+
+    def _peek(self):
+        # Skips whitespace and returns the next character, or '' at the end
+        while True:
+            buf, position = self._buffer, self._position
+            length = len(buf)
+            while position < length and buf[position] in _WHITESPACE:
+                position += 1
+            self._position = position
+            if position < length:
+                return buf[position]
+            if not self._fill():
+                return u''
+
+    def _fill(self):
+        # Appends the next piece of decompressed text to the buffer, dropping
+        # what was already consumed. Returns False when the input is exhausted.
+        while not self._eof:
+            try:
+                if self._inflater.unconsumed_tail:
+                    raw = self._inflater.decompress(self._inflater.unconsumed_tail, READ_SIZE)
+                elif self._offset < len(self._data):
+                    chunk = base64.b64decode(self._data[self._offset:self._offset + BASE64_CHUNK_SIZE])
+                    self._offset += BASE64_CHUNK_SIZE
+                    raw = self._inflater.decompress(chunk, READ_SIZE)
+                else:
+                    self._eof = True
+                    raw = self._inflater.flush()
+            except zlib.error as e:
+                # Malformed data raises ValueError, whatever layer it is in
+                raise ValueError("Malformed gzip in awslogs data: {}".format(e))
+
+            text = self._text_decoder.decode(raw, final=self._eof)
+            if text:
+                self._buffer = self._buffer[self._position:] + text
+                self._position = 0
+                return True
+        return False
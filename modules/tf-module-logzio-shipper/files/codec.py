@@ -0,0 +1,200 @@
+import functools
+import json
+import logging
+
+from records import RECORD_KEYS
+
+logger = logging.getLogger()
+
+AUTO = 'auto'
+
+
+class JsonCodec(object):
+    # json encoding and decoding used for every event. dumps() returns the
+    # encoded event as bytes, ready to be written to a request.
+
+    def __init__(self, name, dumps, loads, dumps_record=None, dumps_string=None):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+        # Encodes a string faster than dumps, when the library has a way to
+        self.dumps_string = dumps_string or dumps
+        # Encodes a LogRecord
+        self.dumps_record = dumps_record or _record_dumps(dumps, self.dumps_string)
+
+    def dumps_many(self, objs):
+        # type: (Iterable[dict]) -> List[bytes]
+        dumps = self.dumps
+        return [dumps(obj) for obj in objs]
+
+    def with_shared_fields(self, fields):
+        # type: (dict) -> JsonCodec
+        # A codec that adds `fields` to every object it encodes. The fields are
+        # encoded once and spliced in after the object's own fields. Objects that
+        # have one of the keys themselves are merged and encoded as a whole,
+        # their own value wins.
+        dumps = self.dumps
+        if not fields:
+            return self
+
+        shared_keys = frozenset(fields)
+        encoded_fields = dumps(fields)[1:-1]
+        separator = b', ' if b', ' in dumps({'a': 0, 'b': 0}) else b','
+        empty_object = b'{' + encoded_fields + b'}'
+        tail = separator + encoded_fields + b'}'
+
+        def dumps_with_shared_fields(obj):
+            if not shared_keys.isdisjoint(obj):
+                merged = dict(fields)
+                merged.update(obj)
+                return dumps(merged)
+            encoded = dumps(obj)
+            if len(encoded) == 2:
+                return empty_object
+            return encoded[:-1] + tail
+
+        return JsonCodec(self.name, dumps_with_shared_fields, self.loads,
+                         _record_dumps(dumps, self.dumps_string, dumps_with_shared_fields, tail, shared_keys),
+                         self.dumps_string)
+
+
+def _record_dumps(dumps, dumps_string, dumps_fields=None, tail=b'}', shared_keys=frozenset()):
+    # Writes the slots of a LogRecord one after the other, in the same format
+    # dumps writes a dict in. Records with other fields, or with values that
+    # aren't strings, and all records when the shared fields have one of the
+    # slots' keys, are encoded as a dict with dumps_fields.
+    dumps_fields = dumps_fields or dumps
+    if not shared_keys.isdisjoint(RECORD_KEYS):
+        return lambda record: dumps_fields(record.to_dict())
+
+    separator = b', ' if b', ' in dumps({'a': 0, 'b': 0}) else b','
+    key_separator = b': ' if b': ' in dumps({'a': 0}) else b':'
+    id_key, message_key, timestamp_key, level_key, request_id_key = (
+        dumps(key) + key_separator for key in RECORD_KEYS)
+    message_key = separator + message_key
+    timestamp_key = separator + timestamp_key
+    level_key = separator + level_key
+    request_id_key = separator + request_id_key
+
+    def dumps_record(record):
+        if record.fields is not None or record.id is None or record.message is None:
+            return dumps_fields(record.to_dict())
+        try:
+            encoded = [b'{', id_key, dumps_string(record.id), message_key, dumps_string(record.message),
+                       timestamp_key, dumps_string(record.timestamp)]
+            if record.level is not None:
+                encoded.append(level_key)
+                encoded.append(dumps_string(record.level))
+            if record.request_id is not None:
+                encoded.append(request_id_key)
+                encoded.append(dumps_string(record.request_id))
+        except TypeError:
+            return dumps_fields(record.to_dict())
+        encoded.append(tail)
+        return b''.join(encoded)
+
+    return dumps_record
+
+
+def _stdlib_dumps():
+    encode = json.JSONEncoder().encode
+    if str is bytes:
+        # Python 2, with ensure_ascii the encoder already returns bytes
+        return encode
+    return lambda obj: encode(obj).encode('utf-8')
+
+
+def _stdlib_dumps_string():
+    # The encoder's own string function, without the type checks of encode().
+    # It raises TypeError for anything but a string.
+    encode_string = json.encoder.encode_basestring_ascii
+    if str is bytes:
+        return encode_string
+    return lambda s: encode_string(s).encode('ascii')
+
+
+def _loads_with_fallback(loads):
+    # The accelerated decoders are stricter than json (NaN, big integers), let
+    # json have the final word on what they reject
+    def loads_with_fallback(s):
+        try:
+            return loads(s)
+        except ValueError:
+            return json.loads(s)
+    return loads_with_fallback
+
+
+def _json_codec():
+    return JsonCodec('json', _stdlib_dumps(), json.loads, dumps_string=_stdlib_dumps_string())
+
+
+def _simplejson_codec():
+    import simplejson
+    # simplejson's defaults match json's, so the output is byte identical
+    encode = simplejson.JSONEncoder().encode
+    dumps = encode if str is bytes else lambda obj: encode(obj).encode('utf-8')
+    return JsonCodec('simplejson', dumps, simplejson.loads)
+
+
+def _ujson_codec():
+    import ujson
+    loads = ujson.loads
+    try:
+        # Older ujson versions round floats unless asked not to
+        ujson.loads('0.1', precise_float=True)
+        loads = functools.partial(ujson.loads, precise_float=True)
+    except TypeError:
+        pass
+
+    def dumps(obj):
+        encoded = ujson.dumps(obj, ensure_ascii=True, escape_forward_slashes=False)
+        return encoded if isinstance(encoded, bytes) else encoded.encode('utf-8')
+    return JsonCodec('ujson', dumps, _loads_with_fallback(loads))
+
+
+def _orjson_codec():
+    import orjson
+    return JsonCodec('orjson', orjson.dumps, _loads_with_fallback(orjson.loads))
+
+
+CODECS = {
+    'json': _json_codec,
+    'simplejson': _simplejson_codec,
+    'ujson': _ujson_codec,
+    'orjson': _orjson_codec,
+}
+
+# With the auto codec, events are decoded with the first of these libraries that
+# is installed, or json when there is none. Encoding stays with json, the only
+# encoder guaranteed to produce the exact same bytes as before. Naming a library
+# picks it for both, the accelerated encoders write compact json ({"a":1}
+# instead of {"a": 1}).
+AUTO_DECODERS = ('orjson', 'ujson', 'simplejson')
+
+_codecs = {}
+
+
+def get_codec(name=AUTO):
+    # type: (str) -> JsonCodec
+    if name not in _codecs:
+        _codecs[name] = _load_codec(name)
+    return _codecs[name]
+
+
+def _load_codec(name):
+    if name == AUTO:
+        for decoder in AUTO_DECODERS:
+            try:
+                loads = CODECS[decoder]().loads
+            except ImportError:
+                continue
+            return JsonCodec("json+{}".format(decoder), _stdlib_dumps(), loads, dumps_string=_stdlib_dumps_string())
+        return _json_codec()
+
+    try:
+        return CODECS[name]()
+    except KeyError:
+        logger.warning("Unknown json codec '{}'. Using json instead".format(name))
+    except ImportError:
+        logger.warning("The json codec '{}' is not installed. Using json instead".format(name))
+    return _json_codec()
@@ -0,0 +1,165 @@
+import collections
+import json
+import logging
+import re
+
+from codec import AUTO
+from dedup import DEFAULT_MAX_ENTRIES, DEFAULT_WINDOW_IN_MILLIS
+from filters import LEVELS
+from shipper import LogzioShipper
+from spill_queue import DEFAULT_SPILL_DIRECTORY
+
+KEY_INDEX = 0
+VALUE_INDEX = 0
+DEFAULT_LOG_TYPE = 'logzio_cloudwatch_lambda'
+DEFAULT_COMPRESS_LEVEL = 9
+# Spilling is opt-in, a spilled bulk only survives in the container's /tmp
+DEFAULT_SPILL_MAX_SIZE = 0
+DEFAULT_SPILL_DRAIN_SIZE = 16 * 1024 * 1024
+# Bulks are sent by a pool of threads, or by an asyncio event loop on Python 3
+THREADS = 'threads'
+ASYNCIO = 'asyncio'
+ENGINES = (THREADS, ASYNCIO)
+
+logger = logging.getLogger()
+
+# Everything the shipper reads from its environment. The Lambda environment
+# doesn't change for the lifetime of a container, so it is parsed once.
+ShipperConfig = collections.namedtuple('ShipperConfig', [
+    'logzio_url',                   # type: str
+    'log_format',                   # type: str
+    'compress',                     # type: bool
+    'enrich',                       # type: Tuple[Tuple[str, str], ...]
+    'log_type',                     # type: str
+    'max_bulks_in_flight',          # type: int
+    'max_bulk_size_in_bytes',       # type: int
+    'json_codec',                   # type: str
+    'compress_level',               # type: int
+    'compress_workers',             # type: int
+    'spill_directory',              # type: str
+    'spill_max_size_in_bytes',      # type: int
+    'spill_drain_size_in_bytes',    # type: int
+    'metrics_namespace',            # type: str
+    'min_level',                    # type: str
+    'drop_patterns',                # type: Tuple[str, ...]
+    'sampling',                     # type: Tuple[Tuple[str, float], ...]
+    'rate_limit_bytes_per_second',  # type: int
+    'rate_limit_burst_bytes',       # type: int
+    'dedup',                        # type: bool
+    'dedup_max_entries',            # type: int
+    'dedup_window_in_millis',       # type: int
+    'engine',                       # type: str
+])
+
+
+def load_config(environ):
+    # type: (Mapping[str, str]) -> ShipperConfig
+    try:
+        logzio_url = "{0}/?token={1}".format(environ['URL'], environ['TOKEN'])
+    except KeyError as e:
+        logger.error("Missing one of the environment variable: {}".format(e))
+        raise
+
+    if 'TYPE' in environ:
+        log_type = environ['TYPE']
+    else:
+        logger.info("Failed to find 'TYPE' environment variables. Using '{}' instead".format(DEFAULT_LOG_TYPE))
+        log_type = DEFAULT_LOG_TYPE
+
+    return ShipperConfig(
+        logzio_url=logzio_url,
+        log_format=environ.get('FORMAT', '').lower(),
+        compress=environ.get('COMPRESS', '').lower() == "true",
+        enrich=_parse_enrich(environ.get('ENRICH', '')),
+        log_type=log_type,
+        max_bulks_in_flight=_get_int(environ, 'MAX_BULKS_IN_FLIGHT', LogzioShipper.MAX_BULKS_IN_FLIGHT),
+        max_bulk_size_in_bytes=_get_int(environ, 'MAX_BULK_SIZE', LogzioShipper.MAX_BULK_SIZE_IN_BYTES),
+        json_codec=environ.get('JSON_CODEC') or AUTO,
+        compress_level=min(9, max(1, _get_int(environ, 'COMPRESS_LEVEL', DEFAULT_COMPRESS_LEVEL))),
+        compress_workers=max(0, _get_int(environ, 'COMPRESS_WORKERS', 0)),
+        spill_directory=environ.get('SPILL_DIRECTORY') or DEFAULT_SPILL_DIRECTORY,
+        spill_max_size_in_bytes=max(0, _get_int(environ, 'SPILL_MAX_SIZE', DEFAULT_SPILL_MAX_SIZE)),
+        spill_drain_size_in_bytes=max(0, _get_int(environ, 'SPILL_DRAIN_SIZE', DEFAULT_SPILL_DRAIN_SIZE)),
+        metrics_namespace=environ.get('METRICS_NAMESPACE', ''),
+        min_level=_parse_min_level(environ.get('MIN_LEVEL', '')),
+        drop_patterns=_parse_drop_patterns(environ.get('DROP_PATTERNS', '')),
+        sampling=_parse_sampling(environ.get('SAMPLING', '')),
+        rate_limit_bytes_per_second=max(0, _get_int(environ, 'RATE_LIMIT', 0)),
+        rate_limit_burst_bytes=max(0, _get_int(environ, 'RATE_LIMIT_BURST', 0)),
+        dedup=environ.get('DEDUP', '').lower() == "true",
+        dedup_max_entries=max(1, _get_int(environ, 'DEDUP_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)),
+        dedup_window_in_millis=max(0, _get_int(environ, 'DEDUP_WINDOW', DEFAULT_WINDOW_IN_MILLIS // 1000)) * 1000,
+        engine=_parse_engine(environ.get('ENGINE', '')),
+    )
+
+
+def _parse_enrich(enrich):
+    # type: (str) -> Tuple[Tuple[str, str], ...]
+    # ENRICH looks like key1=value1;key2=value2
+    if not enrich:
+        return ()
+    properties = []
+    for property_to_enrich in enrich.split(";"):
+        property_key_value = property_to_enrich.split("=")
+        properties.append((property_key_value[KEY_INDEX], property_key_value[VALUE_INDEX]))
+    return tuple(properties)
+
+
+def _parse_min_level(min_level):
+    # type: (str) -> str
+    if min_level and min_level.upper() not in LEVELS:
+        logger.warning("Unknown MIN_LEVEL '{}'. Shipping all levels".format(min_level))
+        return ''
+    return min_level.upper()
+
+
+def _parse_engine(engine):
+    # type: (str) -> str
+    if engine and engine.lower() not in ENGINES:
+        logger.warning("Unknown ENGINE '{}'. Using {} instead".format(engine, THREADS))
+        return THREADS
+    return engine.lower() or THREADS
+
+
+def _parse_drop_patterns(drop_patterns):
+    # type: (str) -> Tuple[str, ...]
+    # DROP_PATTERNS is a json list of regular expressions
+    if not drop_patterns:
+        return ()
+    try:
+        patterns = json.loads(drop_patterns)
+    except ValueError as e:
+        logger.warning("DROP_PATTERNS isn't a json list, ignoring it: {}".format(e))
+        return ()
+    valid_patterns = []
+    for pattern in patterns:
+        try:
+            re.compile(pattern)
+        except (re.error, TypeError) as e:
+            logger.warning("Ignoring the drop pattern {!r}: {}".format(pattern, e))
+            continue
+        valid_patterns.append(pattern)
+    return tuple(valid_patterns)
+
+
+def _parse_sampling(sampling):
+    # type: (str) -> Tuple[Tuple[str, float], ...]
+    # SAMPLING looks like /aws/lambda/noisy-*=0.1;/app/debug=0.5
+    if not sampling:
+        return ()
+    rates = []
+    for group_rate in sampling.split(";"):
+        pattern, _, rate = group_rate.rpartition("=")
+        try:
+            rates.append((pattern, min(1.0, max(0.0, float(rate)))))
+        except ValueError:
+            logger.warning("Ignoring the sampling rate '{}'".format(group_rate))
+    return tuple(rates)
+
+
+def _get_int(environ, name, default):
+    # type: (Mapping[str, str], str, int) -> int
+    try:
+        return int(environ[name])
+    except (KeyError, ValueError):
+        return default
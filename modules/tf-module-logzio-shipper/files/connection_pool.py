@@ -0,0 +1,119 @@
+import logging
+import socket
+import threading
+
+try:
+    import httplib
+    from urlparse import urlsplit
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlsplit
+
+logger = logging.getLogger()
+
+# Errors raised when a kept-alive connection was closed by the server
+CONNECTION_ERRORS = (httplib.HTTPException, socket.error)
+
+
+class ConnectionPool(object):
+    # Keep-alive HTTP(S) connections that are reused across bulks and, when the
+    # pool lives at module level, across warm Lambda invocations.
+
+    def __init__(self, max_idle_connections=8):
+        self._max_idle_connections = max_idle_connections
+        self._idle_connections = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, body, headers, timeout=None):
+        # type: (str, str, Iterable[str], dict, Optional[float]) -> (int, str, httplib.HTTPMessage, str)
+        # body is either a string or an iterable of strings that can be iterated
+        # more than once. The chunks are written to the socket as they are,
+        # without joining them, so headers must carry the Content-Length.
+        # timeout bounds connecting and every read and write, socket.timeout is
+        # raised when the listener stalls.
+        if isinstance(body, bytes):
+            body = (body,)
+        key, path = self._split_url(url)
+
+        connection = self._get_idle_connection(key)
+        if connection is not None:
+            try:
+                connection.sock.settimeout(timeout)
+                return self._do_request(key, connection, method, path, body, headers)
+            except socket.timeout:
+                # The listener stalled, a new connection would wait as long
+                raise
+            except CONNECTION_ERRORS as e:
+                logger.info("Kept-alive connection to {} was closed ({!r}), reconnecting".format(key[1], e))
+
+        return self._do_request(key, self._connect(key, timeout), method, path, body, headers)
+
+    def open_connection(self, url, timeout=None):
+        # type: (str, Optional[float]) -> None
+        # Connects ahead of the first request, so the request doesn't wait for
+        # the TCP and TLS handshakes. timeout only applies to connecting, each
+        # request sets its own.
+        key, _ = self._split_url(url)
+        self._release_connection(key, self._connect(key, timeout))
+
+    def clear(self):
+        with self._lock:
+            idle_connections, self._idle_connections = self._idle_connections, {}
+        for connections in idle_connections.values():
+            for connection in connections:
+                connection.close()
+
+    def _do_request(self, key, connection, method, path, body, headers):
+        try:
+            connection.putrequest(method, path)
+            for header, value in headers.items():
+                connection.putheader(header, value)
+            connection.endheaders()
+            for chunk in body:
+                connection.send(chunk)
+            response = connection.getresponse()
+            response_body = response.read()
+        except CONNECTION_ERRORS:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release_connection(key, connection)
+        return response.status, response.reason, response.msg, response_body
+
+    def _get_idle_connection(self, key):
+        with self._lock:
+            connections = self._idle_connections.get(key)
+            return connections.pop() if connections else None
+
+    def _release_connection(self, key, connection):
+        with self._lock:
+            connections = self._idle_connections.setdefault(key, [])
+            if len(connections) < self._max_idle_connections:
+                connections.append(connection)
+                return
+        connection.close()
+
+    @staticmethod
+    def _split_url(url):
+        split_url = urlsplit(url)
+        path = split_url.path or '/'
+        if split_url.query:
+            path += '?' + split_url.query
+        return (split_url.scheme, split_url.netloc), path
+
+    @staticmethod
+    def _connect(key, timeout=None):
+        scheme, netloc = key
+        connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        if timeout is None:
+            connection = connection_class(netloc)
+        else:
+            connection = connection_class(netloc, timeout=timeout)
+        # The body follows the headers in separate writes, don't let Nagle's
+        # algorithm hold back the last segment of each of them
+        connection.connect()
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
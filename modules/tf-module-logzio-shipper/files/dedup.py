@@ -0,0 +1,103 @@
+import collections
+
+try:
+    _string_types = basestring
+    _integer_types = (int, long)
+except NameError:
+    _string_types = str
+    _integer_types = (int,)
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_WINDOW_IN_MILLIS = 60 * 1000
+
+
+class _Entry(object):
+    # A message that was shipped and the repeats of it that weren't
+    __slots__ = ('log_group', 'shipped_at', 'repeats', 'message', 'level', 'first_timestamp', 'last_timestamp')
+
+    def __init__(self, log_group, shipped_at):
+        self.log_group = log_group
+        self.shipped_at = shipped_at
+        self.repeats = 0
+        self.message = None
+        self.level = None
+        self.first_timestamp = None
+        self.last_timestamp = None
+
+    def summary(self):
+        # type: () -> dict
+        # logGroup is set in case the summary is shipped with another log
+        # group's shared fields
+        summary = {
+            'logGroup': self.log_group,
+            'message': self.message,
+            '@timestamp': self.last_timestamp,
+            'repeat_count': self.repeats,
+            'first_timestamp': self.first_timestamp,
+            'last_timestamp': self.last_timestamp,
+        }
+        if self.level is not None:
+            summary['level'] = self.level
+        return summary
+
+
+class Deduplicator(object):
+    # Folds repeats of a message into a summary event. The first occurrence of
+    # a message of a log group is shipped, the ones that follow within the
+    # window are counted instead, and pop_summaries() returns an event with
+    # their count and first and last timestamps. The messages are remembered by
+    # their hash in a bounded LRU, which is kept across warm invocations.
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, window_in_millis=DEFAULT_WINDOW_IN_MILLIS):
+        self._max_entries = max_entries
+        self._window_in_millis = window_in_millis
+        self._entries = collections.OrderedDict()
+        self._repeated = {}
+        self._summaries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_repeat(self, log_group, record, timestamp):
+        # type: (str, LogRecord, int) -> bool
+        # timestamp is the event's CloudWatch timestamp, in milliseconds
+        message = record.message
+        if not isinstance(message, _string_types) or not isinstance(timestamp, _integer_types):
+            return False
+        key = hash((log_group, message))
+        entry = self._entries.pop(key, None)
+        if entry is not None and abs(timestamp - entry.shipped_at) <= self._window_in_millis:
+            # Most recently used entries are last
+            self._entries[key] = entry
+            if not entry.repeats:
+                entry.message = message
+                entry.level = record.level
+                entry.first_timestamp = record.timestamp
+                self._repeated[key] = entry
+            entry.repeats += 1
+            entry.last_timestamp = record.timestamp
+            return True
+
+        if entry is not None:
+            self._retire(key, entry)
+        self._entries[key] = _Entry(log_group, timestamp)
+        if len(self._entries) > self._max_entries:
+            self._retire(*self._entries.popitem(last=False))
+        return False
+
+    def pop_summaries(self):
+        # type: () -> List[Tuple[str, dict]]
+        # (log group, summary event) of the repeats counted since the last call
+        summaries, self._summaries = self._summaries, []
+        for entry in self._repeated.values():
+            summaries.append((entry.log_group, entry.summary()))
+            entry.repeats = 0
+            entry.message = None
+        self._repeated = {}
+        return summaries
+
+    def _retire(self, key, entry):
+        # The entry is replaced or evicted, its repeats are summarized now
+        if entry.repeats:
+            self._summaries.append((entry.log_group, entry.summary()))
+            del self._repeated[key]
@@ -0,0 +1,133 @@
+import collections
+import fnmatch
+import random
+import re
+
+from metrics import timer
+
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+# Levels below the minimum level are dropped. Events without a level, or with
+# one that isn't here, are always kept.
+LEVELS = {
+    'TRACE': 0,
+    'DEBUG': 1,
+    'INFO': 2,
+    'NOTICE': 3,
+    'WARN': 4,
+    'WARNING': 4,
+    'ERROR': 5,
+    'CRITICAL': 6,
+    'FATAL': 6,
+}
+
+DROPPED_BY_SAMPLING = 'DroppedBySampling'
+DROPPED_BY_PATTERN = 'DroppedByPattern'
+DROPPED_BY_LEVEL = 'DroppedByLevel'
+DROPPED_BY_RATE_LIMIT = 'DroppedByRateLimit'
+
+
+class TokenBucket(object):
+    # Allows rate units per second on average and up to burst at once
+
+    def __init__(self, rate, burst, clock=timer):
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._clock = clock
+        self._tokens = self._burst
+        self._updated = clock()
+
+    def consume(self, amount):
+        # type: (float) -> bool
+        now = self._clock()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        if self._tokens < amount:
+            return False
+        self._tokens -= amount
+        return True
+
+
+class LogFilter(object):
+    # Decides which events are shipped. It is built once per container, the
+    # rate limit is shared by all its invocations. Events are checked in the
+    # order that costs the least for the ones that are dropped: sampling and
+    # drop patterns look at the event before it is parsed, the minimum level
+    # and the rate limit at the parsed record.
+
+    def __init__(self, min_level='', drop_patterns=(), sampling=(), rate_limit_bytes_per_second=0,
+                 rate_limit_burst_bytes=0):
+        # type: (str, Iterable[str], Iterable[Tuple[str, float]], int, int) -> None
+        # sampling holds (log group pattern, rate) pairs, the first pattern that
+        # matches the log group sets the rate of its events
+        self._min_level = LEVELS[min_level.upper()] if min_level else None
+        drop_patterns = tuple(drop_patterns)
+        self._drop_pattern = re.compile('|'.join('(?:{})'.format(pattern) for pattern in drop_patterns)) \
+            if drop_patterns else None
+        self._sampling = tuple(sampling)
+        self._rate_limit = TokenBucket(rate_limit_bytes_per_second,
+                                       rate_limit_burst_bytes or rate_limit_bytes_per_second) \
+            if rate_limit_bytes_per_second else None
+        self.dropped = collections.Counter()
+
+    def sampling_rate(self, log_group):
+        # type: (str) -> float
+        for pattern, rate in self._sampling:
+            if fnmatch.fnmatchcase(log_group, pattern):
+                return rate
+        return 1.0
+
+    def event_filter(self, log_group):
+        # type: (str) -> Optional[Callable[[dict], bool]]
+        # Tells whether an event of log_group is kept, before it is parsed.
+        # None when all of them are.
+        rate = self.sampling_rate(log_group)
+        drop_pattern = self._drop_pattern
+        if rate >= 1 and drop_pattern is None:
+            return None
+        search = drop_pattern.search if drop_pattern is not None else None
+        sample = random.random
+        dropped = self.dropped
+
+        def keep_event(event):
+            if rate < 1 and sample() >= rate:
+                dropped[DROPPED_BY_SAMPLING] += 1
+                return False
+            if search is not None:
+                message = event.get('message')
+                if isinstance(message, _string_types) and search(message):
+                    dropped[DROPPED_BY_PATTERN] += 1
+                    return False
+            return True
+
+        return keep_event
+
+    def record_filter(self):
+        # type: () -> Optional[Callable[[LogRecord], bool]]
+        # Tells whether a parsed record is kept, None when all of them are
+        min_level = self._min_level
+        rate_limit = self._rate_limit
+        if min_level is None and rate_limit is None:
+            return None
+        dropped = self.dropped
+
+        def keep_record(record):
+            if min_level is not None:
+                level = record.level
+                if record.fields and 'level' in record.fields:
+                    level = record.fields['level']
+                if isinstance(level, _string_types) and LEVELS.get(level.upper(), min_level) < min_level:
+                    dropped[DROPPED_BY_LEVEL] += 1
+                    return False
+            if rate_limit is not None:
+                # The size of the message stands for the size of the event
+                message = record.message
+                if not rate_limit.consume(len(message) if isinstance(message, _string_types) else 0):
+                    dropped[DROPPED_BY_RATE_LIMIT] += 1
+                    return False
+            return True
+
+        return keep_record
@@ -1,126 +1,498 @@
-import gzip
-import json
 import logging
 import os
+import re
 
-from shipper import LogzioShipper
-from StringIO import StringIO
+from aws_logs import AwsLogsReader
+from codec import get_codec
+from config import ASYNCIO, load_config
+from dedup import Deduplicator
+from filters import LogFilter
+from metrics import InvocationMetrics, timer
+from records import LogRecord
+import shipper as threads_shipper
+from spill_queue import SpillQueue
 
-KEY_INDEX = 0
-VALUE_INDEX = 0
+ADDITIONAL_FIELDS = ('logGroup', 'logStream', 'messageType', 'owner')
+# "[LEVEL]\t<timestamp>\t<request id>\t<message>", the message itself has no tabs
+LAMBDA_LOG_MESSAGE = re.compile(r'\[([^\]]*)\].([^\t]*)\t([^\t]*)\t([^\t]*)\Z', re.DOTALL)
+LAMBDA_REPORT_PREFIXES = ('START', 'END', 'REPORT')
+JSON_OBJECT_START = re.compile(r'\s*\{')
+CONTROL_MESSAGE = 'CONTROL_MESSAGE'
+# Returned for the events the deduplicator folds
+REPEAT = object()
 
 # set logger
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Loaded on the first invocation of the container
+_config = None
+_spill_queue = None
+_log_filter = None
+_deduplicator = None
+_engine = None
 
-def _extract_aws_logs_data(event):
-    # type: (dict) -> dict
+
+def _extract_aws_logs_data(data):
+    # type: (str) -> (dict, Iterator[dict])
+    # Returns the payload's top level fields and an iterator that decodes the
+    # logEvents one at a time while they are being shipped. data is the base64
+    # encoded, gzipped payload of a subscription.
     try:
-        logs_data_decoded = event['awslogs']['data'].decode('base64')
-        logs_data_unzipped = gzip.GzipFile(fileobj=StringIO(logs_data_decoded)).read()
-        logs_data_dict = json.loads(logs_data_unzipped)
-        return logs_data_dict
+        reader = AwsLogsReader(data, header_fields=ADDITIONAL_FIELDS)
     except ValueError as e:
         logger.error("Got exception while loading json, message: {}".format(e))
         raise ValueError("Exception: json loads")
+    return reader.header, _iter_log_events(reader)
+
+
+def _iter_log_events(reader):
+    # type: (AwsLogsReader) -> Iterator[dict]
+    try:
+        for log in reader.log_events():
+            yield log
+    except ValueError as e:
+        logger.error("Got exception while loading json, message: {}".format(e))
+        raise ValueError("Exception: json loads")
+
+
+def _get_log_message_parser(log_group):
+    # type: (str) -> Callable[[LogRecord], None]
+    # The log group is the same for the whole batch, so the parser is picked once
+    if '/aws/lambda/' in log_group:
+        return _extract_lambda_log_message
+    return _keep_log_message
+
 
+def _keep_log_message(log):
+    # type: (LogRecord) -> None
+    pass
 
-def _extract_lambda_log_message(log, log_group):
+
+def _extract_lambda_log_message(log):
+    # type: (LogRecord) -> None
     # Lambda function log message looks like this:
     # "[LEVEL]\t2017-04-26T10:41:09.023Z\tdb95c6da-2a6c-11e7-9550-c91b65931beb\tloading index.html...\n"
     # but there are START, END and REPORT messages too:
     # "START RequestId: 67c005bb-641f-11e6-b35d-6b6c651a2f01 Version: 31\n"
     # "END RequestId: 5e665f81-641f-11e6-ab0f-b1affae60d28\n"
     # "REPORT RequestId: 5e665f81-641f-11e6-ab0f-b1affae60d28\tDuration: 1095.52 ms\tBilled Duration: 1100 ms \tMemory Size
-    if '/aws/lambda/' in log_group:
-        str_message = str(log['message'])
-        if str_message.startswith('START') \
-                or str_message.startswith('END') \
-                or str_message.startswith('REPORT'):
-            return
+    message = log.message
+    match = LAMBDA_LOG_MESSAGE.match(message)
+    if match:
+        log.level, log.timestamp, log.request_id, log.message = match.groups()
+        return
 
-        end_level = 0
-        try:
-            start_level = str_message.index('[')
-            end_level = str_message.index(']')
-            log['level'] = str_message[start_level+1:end_level]
-        except ValueError:
-            pass
+    if message.startswith(LAMBDA_REPORT_PREFIXES):
+        return
 
-        message_parts = str_message[end_level+2:].split('\t')
-        if len(message_parts) == 3:
-            log['@timestamp'] = message_parts[0]
-            log['requestID'] = message_parts[1]
-            log['message'] = message_parts[2]
+    # Anything else that still carries a level, e.g. "[ERROR] message"
+    end_level = 0
+    try:
+        start_level = message.index('[')
+        end_level = message.index(']')
+        log.level = message[start_level+1:end_level]
+    except ValueError:
+        pass
 
+    message_parts = message[end_level+2:].split('\t')
+    if len(message_parts) == 3:
+        log.timestamp, log.request_id, log.message = message_parts
 
-def _parse_cloudwatch_log(log, additional_data):
-    # type: (dict, dict) -> None
-    if '@timestamp' not in log:
-        log['@timestamp'] = str(log['timestamp'])
-        del log['timestamp']
 
-    _extract_lambda_log_message(log, additional_data['logGroup'])
-    log.update(additional_data)
+def _get_log_format_parser(log_format, codec):
+    # type: (str, JsonCodec) -> Callable[[LogRecord], None]
+    if log_format != 'json':
+        return _keep_log_message
+
+    loads = codec.loads
+
+    def merge_json_message(log):
+        # type: (LogRecord) -> None
+        # If FORMAT is json treat message as a json. Messages that can't hold a
+        # json object are skipped without trying to parse them.
+        message = log.message
+        if not JSON_OBJECT_START.match(message):
+            return
+        try:
+            json_object = loads(message)
+        except ValueError:
+            return
+        log.update(json_object)
+
+    return merge_json_message
 
-    # If FORMAT is json treat message as a json
-    try:
-        if os.environ['FORMAT'].lower() == 'json':
-            json_object = json.loads(log['message'])
-            for key, value in json_object.items():
-                log[key] = value
-    except (KeyError, ValueError):
-        pass
 
+def _parse_cloudwatch_log(log, parse_log_message, parse_log_format):
+    # type: (dict, Callable[[LogRecord], None], Callable[[LogRecord], None]) -> LogRecord
+    # The additional data is added by the shipper while serializing the record
+    record = LogRecord.from_event(log)
+    parse_log_message(record)
+    parse_log_format(record)
+    return record
 
-def _get_additional_logs_data(aws_logs_data, context):
-    # type: (dict, 'LambdaContext') -> dict
-    additional_fields = ['logGroup', 'logStream', 'messageType', 'owner']
-    additional_data = dict((key, aws_logs_data[key]) for key in additional_fields)
+
+def _get_additional_logs_data(aws_logs_data, context, config):
+    # type: (dict, 'LambdaContext', ShipperConfig) -> dict
+    additional_data = dict((key, aws_logs_data[key]) for key in ADDITIONAL_FIELDS)
     try:
         additional_data['function_version'] = context.function_version
         additional_data['invoked_function_arn'] = context.invoked_function_arn
     except KeyError:
         logger.info('Failed to find context value. Continue without adding it to the log')
 
-    try:
-        # If ENRICH has value, add the properties
-        if os.environ['ENRICH']:
-            properties_to_enrich = os.environ['ENRICH'].split(";")
-            for property_to_enrich in properties_to_enrich:
-                property_key_value = property_to_enrich.split("=")
-                additional_data[property_key_value[KEY_INDEX]] = property_key_value[VALUE_INDEX]
-    except KeyError:
-        pass
-
-    try:
-        additional_data['type'] = os.environ['TYPE']
-    except KeyError:
-        logger.info("Failed to find 'TYPE' environment variables. Using 'logzio_cloudwatch_lambda' instead")
-        additional_data['type'] = 'logzio_cloudwatch_lambda'
+    # If ENRICH has value, add the properties
+    additional_data.update(config.enrich)
+    additional_data['type'] = config.log_type
 
     return additional_data
 
 
+def _get_config():
+    # type: () -> ShipperConfig
+    global _config
+    if _config is None:
+        _config = load_config(os.environ)
+    return _config
+
+
+def _get_spill_queue(config):
+    # type: (ShipperConfig) -> Optional[SpillQueue]
+    # Shared by the invocations of the container, a SPILL_MAX_SIZE of 0 disables it
+    global _spill_queue
+    if _spill_queue is None and config.spill_max_size_in_bytes:
+        _spill_queue = SpillQueue(config.spill_directory, config.spill_max_size_in_bytes)
+    return _spill_queue
+
+
+def _get_log_filter(config):
+    # type: (ShipperConfig) -> LogFilter
+    # Compiled once per container, its rate limit spans invocations
+    global _log_filter
+    if _log_filter is None:
+        _log_filter = LogFilter(config.min_level, config.drop_patterns, config.sampling,
+                                config.rate_limit_bytes_per_second, config.rate_limit_burst_bytes)
+    return _log_filter
+
+
+def _get_deduplicator(config):
+    # type: (ShipperConfig) -> Optional[Deduplicator]
+    # Its cache is kept across warm invocations
+    global _deduplicator
+    if _deduplicator is None and config.dedup:
+        _deduplicator = Deduplicator(config.dedup_max_entries, config.dedup_window_in_millis)
+    return _deduplicator
+
+
+def _get_engine(config):
+    # type: (ShipperConfig) -> module
+    # The module with the LogzioShipper and prepare() of the configured engine
+    global _engine
+    if _engine is None:
+        _engine = threads_shipper
+        if config.engine == ASYNCIO:
+            try:
+                import async_shipper
+                _engine = async_shipper
+            except (ImportError, SyntaxError):
+                logger.warning("The {} engine needs Python 3. Sending bulks with threads instead".format(ASYNCIO))
+    return _engine
+
+
+def _new_metrics(config, context):
+    # type: (ShipperConfig, 'LambdaContext') -> Optional[InvocationMetrics]
+    # An empty METRICS_NAMESPACE disables the metrics
+    if not config.metrics_namespace:
+        return None
+    function_name = getattr(context, 'function_name', None)
+    metrics = InvocationMetrics(config.metrics_namespace, (('FunctionName', function_name),) if function_name else ())
+    if hasattr(context, 'aws_request_id'):
+        metrics.set_property('RequestId', context.aws_request_id)
+    return metrics
+
+
+def _warm_up():
+    # Runs while the container initializes, so the first invocation finds the
+    # configuration loaded, the codec imported, the sender threads started and
+    # a connection to the listener open
+    if 'URL' not in os.environ or 'TOKEN' not in os.environ:
+        # The invocation reports what is missing
+        return
+    config = _get_config()
+    get_codec(config.json_codec)
+    _get_spill_queue(config)
+    _get_log_filter(config)
+    _get_deduplicator(config)
+    _get_engine(config).prepare(config.logzio_url, config.max_bulks_in_flight, config.compress,
+                                config.compress_workers)
+
+
 def lambda_handler(event, context):
     # type: (dict, 'LambdaContext') -> None
+    # Entry point for a CloudWatch Logs subscription that invokes the function
+    _invoke(_ship_logs, event, context)
+
+
+def records_handler(event, context):
+    # type: (dict, 'LambdaContext') -> Optional[dict]
+    # Entry point for CloudWatch Logs subscriptions delivered through a Kinesis
+    # data stream or a Firehose delivery stream. All the records of the batch
+    # share the same bulks. Firehose gets a result for every record.
+    return _invoke(_ship_records, event, context)
+
+
+def _invoke(ship, event, context):
+    config = _get_config()
+    metrics = _new_metrics(config, context)
+    log_filter = _get_log_filter(config)
+    log_filter.dropped.clear()
     try:
-        logzio_url = "{0}/?token={1}".format(os.environ['URL'], os.environ['TOKEN'])
-    except KeyError as e:
-        logger.error("Missing one of the environment variable: {}".format(e))
+        return ship(event, context, config, log_filter, metrics)
+    except Exception as e:
+        if metrics is not None:
+            metrics.set_property('Error', type(e).__name__)
         raise
+    finally:
+        if log_filter.dropped:
+            logger.info("Dropped {} logs: {}".format(sum(log_filter.dropped.values()), ", ".join(
+                "{} {}".format(count, reason) for reason, count in sorted(log_filter.dropped.items()))))
+        if metrics is not None:
+            for reason, count in log_filter.dropped.items():
+                metrics.add(reason, count)
+            metrics.emit()
+
+
+def _new_shipper(config, context, codec, metrics):
+    # type: (ShipperConfig, 'LambdaContext', JsonCodec, Optional[InvocationMetrics]) -> LogzioShipper
+    # Sends what earlier invocations spilled before anything else
+    logzio_shipper = _get_engine(config).LogzioShipper(
+        config.logzio_url,
+        max_bulks_in_flight=config.max_bulks_in_flight,
+        max_bulk_size_in_bytes=config.max_bulk_size_in_bytes,
+        compress=config.compress,
+        codec=codec,
+        compress_level=config.compress_level,
+        compress_workers=config.compress_workers,
+        remaining_time_in_millis=getattr(context, 'get_remaining_time_in_millis', None),
+        spill_queue=_get_spill_queue(config),
+        metrics=metrics)
+    logzio_shipper.send_spilled(config.spill_drain_size_in_bytes)
+    return logzio_shipper
+
+
+def _ship_logs(event, context, config, log_filter, metrics):
+    # type: (dict, 'LambdaContext', ShipperConfig, LogFilter, Optional[InvocationMetrics]) -> None
+    start = timer()
+    aws_logs_data, log_events = _extract_aws_logs_data(event['awslogs']['data'])
+    decode_seconds = timer() - start
+    codec = get_codec(config.json_codec)
+    shipper = _new_shipper(config, context, codec, metrics)
+
+    if metrics is not None:
+        metrics.set_property('LogGroup', aws_logs_data['logGroup'])
+    additional_data = _get_additional_logs_data(aws_logs_data, context, config)
+    parse_log_format = _get_log_format_parser(config.log_format, codec)
+    logs_counter = _ship_log_events(shipper, log_events, additional_data, parse_log_format, log_filter,
+                                    _get_deduplicator(config), metrics)
+    _flush(shipper, metrics)
+    logger.info("Sent {} logs".format(logs_counter))
+    if metrics is not None:
+        metrics.add_time('DecodeTime', decode_seconds)
+
+
+def _ship_records(event, context, config, log_filter, metrics):
+    # type: (dict, 'LambdaContext', ShipperConfig, LogFilter, Optional[InvocationMetrics]) -> Optional[dict]
+    firehose = 'records' in event
+    records = event['records'] if firehose else event['Records']
+    codec = get_codec(config.json_codec)
+    shipper = _new_shipper(config, context, codec, metrics)
+    parse_log_format = _get_log_format_parser(config.log_format, codec)
+    deduplicator = _get_deduplicator(config)
+
+    logger.info("About to send logs of {} records".format(len(records)))
+    results = []
+    logs_counter = 0
+    for record in records:
+        data = record['data'] if firehose else record['kinesis']['data']
+        result = 'Ok'
+        try:
+            start = timer()
+            aws_logs_data, log_events = _extract_aws_logs_data(data)
+            if metrics is not None:
+                metrics.add_time('DecodeTime', timer() - start)
+            if aws_logs_data.get('messageType') == CONTROL_MESSAGE:
+                # Sent by CloudWatch Logs to check the destination is reachable
+                result = 'Dropped'
+            else:
+                # The record's logs are shipped only once all of its events were
+                # decoded and parsed, a record that fails adds nothing
+                additional_data = _get_additional_logs_data(aws_logs_data, context, config)
+                buffer = _LogsBuffer()
+                record_logs_counter = _ship_log_events(buffer, log_events, additional_data, parse_log_format,
+                                                       log_filter, deduplicator, metrics)
+                start = timer()
+                buffer.ship(shipper)
+                if metrics is not None:
+                    metrics.add_time('SerializeTime', timer() - start)
+                logs_counter += record_logs_counter
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error("Skipping malformed record {}: {!r}".format(
+                record.get('recordId') or record.get('eventID'), e))
+            result = 'ProcessingFailed'
+            if metrics is not None:
+                metrics.add('FailedRecords', 1)
+        if firehose:
+            results.append({'recordId': record['recordId'], 'result': result, 'data': data})
+
+    _flush(shipper, metrics)
+    logger.info("Sent {} logs of {} records".format(logs_counter, len(records)))
+    if metrics is not None:
+        metrics.add('Records', len(records))
+    if firehose:
+        return {'records': results}
+
 
-    aws_logs_data = _extract_aws_logs_data(event)
-    additional_data = _get_additional_logs_data(aws_logs_data, context)
-    shipper = LogzioShipper(logzio_url)
+class _LogsBuffer(object):
+    # Stands in for the shipper while the events of a Kinesis or Firehose
+    # record are parsed, and adds them to the shipper afterwards
 
-    logger.info("About to send {} logs".format(len(aws_logs_data['logEvents'])))
-    for log in aws_logs_data['logEvents']:
+    def __init__(self):
+        self._shared_fields = None
+        self._logs = []
+
+    def set_shared_fields(self, fields):
+        # type: (dict) -> None
+        self._shared_fields = fields
+
+    def add_record(self, record):
+        # type: (LogRecord) -> None
+        self._logs.append((True, record))
+
+    def add(self, log):
+        # type: (dict) -> None
+        self._logs.append((False, log))
+
+    def ship(self, shipper):
+        # type: (LogzioShipper) -> None
+        shipper.set_shared_fields(self._shared_fields)
+        add_record = shipper.add_record
+        add = shipper.add
+        for is_record, log in self._logs:
+            if is_record:
+                add_record(log)
+            else:
+                add(log)
+
+
+def _ship_log_events(shipper, log_events, additional_data, parse_log_format, log_filter, deduplicator, metrics):
+    # type: (LogzioShipper, Iterator[dict], dict, Callable, LogFilter, Optional[Deduplicator], Optional[InvocationMetrics]) -> int
+    # Ships the events of one subscription payload, additional_data is added to
+    # all of them. Returns how many were shipped, repeat summaries included.
+    log_group = additional_data['logGroup']
+    shipper.set_shared_fields(additional_data)
+    parse_event = _get_event_parser(log_group, parse_log_format, log_filter, deduplicator)
+
+    logger.info("About to send logs of {}".format(log_group))
+    # The loop is only timed when the metrics are emitted
+    if metrics is None:
+        logs_counter, repeats = _add_events(shipper, log_events, parse_event)
+    else:
+        logs_counter, repeats = _add_events_timed(shipper, log_events, parse_event, metrics)
+
+    if deduplicator is not None:
+        summaries = deduplicator.pop_summaries()
+        for _, summary in summaries:
+            shipper.add(summary)
+        logs_counter += len(summaries)
+        if repeats:
+            logger.info("Folded {} repeated logs into {} summaries".format(repeats, len(summaries)))
+        if metrics is not None:
+            metrics.add('RepeatedEvents', repeats)
+            metrics.add('RepeatSummaries', len(summaries))
+
+    if metrics is not None:
+        metrics.add('Events', logs_counter)
+    return logs_counter
+
+
+def _get_event_parser(log_group, parse_log_format, log_filter, deduplicator):
+    # type: (str, Callable, LogFilter, Optional[Deduplicator]) -> Callable[[dict], Optional[LogRecord]]
+    # Returns a function that parses an event into the record to ship, or
+    # returns None when the event is filtered out and REPEAT when it is folded
+    parse_log_message = _get_log_message_parser(log_group)
+    keep_event = log_filter.event_filter(log_group)
+    keep_record = log_filter.record_filter()
+
+    def parse_event(log):
         if not isinstance(log, dict):
             raise TypeError("Expected log inside logEvents to be a dict but found another type")
 
-        _parse_cloudwatch_log(log, additional_data)
-        shipper.add(log)
+        # Filtered events are dropped before they are serialized
+        if keep_event is not None and not keep_event(log):
+            return None
+        record = _parse_cloudwatch_log(log, parse_log_message, parse_log_format)
+        if keep_record is not None and not keep_record(record):
+            return None
+        if deduplicator is not None and deduplicator.is_repeat(log_group, record, log.get('timestamp')):
+            return REPEAT
+        return record
+    return parse_event
+
+
+def _add_events(shipper, log_events, parse_event):
+    # type: (LogzioShipper, Iterator[dict], Callable) -> (int, int)
+    # Returns how many events were added and how many were repeats
+    logs_counter = 0
+    repeats = 0
+    for log in log_events:
+        record = parse_event(log)
+        if record is None:
+            continue
+        if record is REPEAT:
+            repeats += 1
+            continue
+        shipper.add_record(record)
+        logs_counter += 1
+    return logs_counter, repeats
+
 
+def _add_events_timed(shipper, log_events, parse_event, metrics):
+    # type: (LogzioShipper, Iterator[dict], Callable, InvocationMetrics) -> (int, int)
+    # _add_events, also recording the time spent decoding, parsing and adding
+    # the events
+    logs_counter = 0
+    repeats = 0
+    decode_seconds = parse_seconds = add_seconds = 0.0
+    # The events are decoded while they are iterated
+    added = timer()
+    for log in log_events:
+        decoded = timer()
+        record = parse_event(log)
+        parsed = timer()
+        if record is REPEAT:
+            repeats += 1
+        elif record is not None:
+            shipper.add_record(record)
+            logs_counter += 1
+        decode_seconds += decoded - added
+        parse_seconds += parsed - decoded
+        added = timer()
+        add_seconds += added - parsed
+    decode_seconds += timer() - added
+
+    metrics.add_time('DecodeTime', decode_seconds)
+    metrics.add_time('ParseTime', parse_seconds)
+    # Serializing and writing to the bulk, compressing when bulks are compressed
+    metrics.add_time('SerializeTime', add_seconds)
+    return logs_counter, repeats
+
+
+def _flush(shipper, metrics):
+    # type: (LogzioShipper, Optional[InvocationMetrics]) -> None
+    start = timer()
     shipper.flush()
+    if metrics is not None:
+        metrics.add_time('FlushTime', timer() - start)
+
+
+_warm_up()
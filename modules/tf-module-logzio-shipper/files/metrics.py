@@ -0,0 +1,104 @@
+import json
+import resource
+import sys
+import threading
+import time
+import timeit
+
+COUNT = 'Count'
+BYTES = 'Bytes'
+KILOBYTES = 'Kilobytes'
+MILLISECONDS = 'Milliseconds'
+MICROSECONDS = 'Microseconds'
+NONE = 'None'
+
+DEFAULT_NAMESPACE = 'LogzioShipper'
+LATENCY_PERCENTILES = (50, 90, 99)
+
+timer = timeit.default_timer
+
+
+def _percentile(sorted_values, percentile):
+    # Nearest rank
+    index = int(len(sorted_values) * percentile / 100.0 + 0.5) - 1
+    return sorted_values[min(len(sorted_values) - 1, max(0, index))]
+
+
+class InvocationMetrics(object):
+    # Measurements of one invocation, written by emit() as a single line in the
+    # CloudWatch Embedded Metric Format. CloudWatch extracts the metrics from
+    # the function's log, without any API call. The shipper's sender threads
+    # record into it too.
+
+    def __init__(self, namespace=DEFAULT_NAMESPACE, dimensions=()):
+        # type: (str, Iterable[Tuple[str, str]]) -> None
+        self._namespace = namespace
+        self._dimensions = tuple(dimensions)
+        self._lock = threading.Lock()
+        self._values = {}
+        self._units = []
+        self._latencies = []
+        self._properties = {}
+        self._start = timer()
+
+    def add(self, name, value, unit=COUNT):
+        with self._lock:
+            if name not in self._values:
+                self._values[name] = 0
+                self._units.append((name, unit))
+            self._values[name] += value
+
+    def add_time(self, name, seconds):
+        self.add(name, seconds * 1000, MILLISECONDS)
+
+    def add_latency(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds * 1000)
+
+    def set_property(self, name, value):
+        # Written to the line without becoming a metric
+        self._properties[name] = value
+
+    def to_emf(self, timestamp=None):
+        # type: (Optional[float]) -> dict
+        self.add_time('Duration', timer() - self._start)
+        # ru_maxrss is in kilobytes on Linux
+        self.add('PeakMemory', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, KILOBYTES)
+        with self._lock:
+            values = dict(self._values)
+            units = list(self._units)
+            latencies = sorted(self._latencies)
+
+        events = values.get('Events')
+        if events and 'ParseTime' in values:
+            values['ParseTimePerEvent'] = values['ParseTime'] * 1000 / events
+            units.append(('ParseTimePerEvent', MICROSECONDS))
+        if values.get('BytesSent') and 'UncompressedBytes' in values:
+            values['CompressionRatio'] = float(values['UncompressedBytes']) / values['BytesSent']
+            units.append(('CompressionRatio', NONE))
+        if latencies:
+            for percentile in LATENCY_PERCENTILES:
+                name = 'HttpLatencyP{}'.format(percentile)
+                values[name] = _percentile(latencies, percentile)
+                units.append((name, MILLISECONDS))
+            values['HttpLatencyMax'] = latencies[-1]
+            units.append(('HttpLatencyMax', MILLISECONDS))
+
+        emf = dict(self._properties)
+        emf.update(self._dimensions)
+        emf.update(values)
+        emf['_aws'] = {
+            'Timestamp': int((time.time() if timestamp is None else timestamp) * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self._namespace,
+                'Dimensions': [[name for name, _ in self._dimensions]],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, unit in units],
+            }],
+        }
+        return emf
+
+    def emit(self, stream=None):
+        # The line has to be the whole log message, not go through the logger
+        stream = stream or sys.stdout
+        stream.write(json.dumps(self.to_emf(), sort_keys=True) + '\n')
+        stream.flush()
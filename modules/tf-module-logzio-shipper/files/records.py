@@ -0,0 +1,55 @@
+ID = 'id'
+MESSAGE = 'message'
+TIMESTAMP = '@timestamp'
+LEVEL = 'level'
+REQUEST_ID = 'requestID'
+
+# The keys of a record's slots, in the order they are serialized
+RECORD_KEYS = (ID, MESSAGE, TIMESTAMP, LEVEL, REQUEST_ID)
+
+
+class LogRecord(object):
+    # A log event on its way from the payload to a bulk. CloudWatch events only
+    # have an id, a timestamp and a message, and parsing the message may add a
+    # level and a request id. Those live in slots and are serialized without
+    # building a dict. Any other field, e.g. merged from a json message, is
+    # kept in fields. None means a slot isn't set.
+    __slots__ = ('id', 'message', 'timestamp', 'level', 'request_id', 'fields')
+
+    def __init__(self, id, message, timestamp, fields=None):
+        self.id = id
+        self.message = message
+        self.timestamp = timestamp
+        self.level = None
+        self.request_id = None
+        self.fields = fields
+
+    @classmethod
+    def from_event(cls, event):
+        # type: (dict) -> LogRecord
+        if len(event) == 3 and ID in event and MESSAGE in event and 'timestamp' in event:
+            return cls(event[ID], event[MESSAGE], str(event['timestamp']))
+
+        # Anything unusual keeps all of its fields
+        fields = dict(event)
+        if TIMESTAMP not in fields:
+            fields[TIMESTAMP] = str(fields.pop('timestamp'))
+        return cls(fields.pop(ID, None), fields.pop(MESSAGE, None), fields.pop(TIMESTAMP), fields or None)
+
+    def update(self, fields):
+        # type: (dict) -> None
+        # Fields that are updated win over the slots
+        if self.fields is None:
+            self.fields = fields
+        else:
+            self.fields.update(fields)
+
+    def to_dict(self):
+        # type: () -> dict
+        log = {}
+        for key, value in zip(RECORD_KEYS, (self.id, self.message, self.timestamp, self.level, self.request_id)):
+            if value is not None:
+                log[key] = value
+        if self.fields:
+            log.update(self.fields)
+        return log
@@ -1,16 +1,52 @@
-import gzip
-import json
+import collections
 import logging
-import sys
+import socket
 import time
-import urllib2
-import StringIO
-import os
+import zlib
+
+try:
+    import urllib2
+except ImportError:
+    import urllib.error as urllib2
+
+from codec import get_codec
+from connection_pool import ConnectionPool, CONNECTION_ERRORS
+from metrics import BYTES, timer
+from workers import WorkerPool
 
 # set logger
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Size of the pieces a StringLogRequest body is written to the socket in
+BODY_CHUNK_SIZE = 64 * 1024
+
+# Threads that send the bulks and their keep-alive connections, and the threads
+# that compress them. All of them are kept across warm invocations.
+_sender_pool = WorkerPool('logzio-sender')
+_connection_pool = ConnectionPool()
+_compressor_pool = WorkerPool('logzio-compressor')
+
+# Modules that are only needed once something fails, or when compressing, are
+# imported when they are first used to keep them out of the cold start.
+
+# The listener answers these when it is overloaded, bulks are made smaller
+# until it accepts them again
+BACK_PRESSURE_STATUS_CODES = (429, 503)
+MIN_BULK_SIZE_IN_BYTES = 64 * 1024
+# Time kept for the attempt itself and for spilling the bulk when it fails
+RETRY_DEADLINE_MARGIN_IN_MILLIS = 10000
+# Shortest socket timeout of an attempt, however little time is left
+MIN_ATTEMPT_TIMEOUT = 1
+# Spilled bulks are sent with a short timeout and within a share of the
+# remaining time, most of it is kept for the invocation's own logs
+SPILL_DRAIN_ATTEMPT_TIMEOUT = 3
+SPILL_DRAIN_TIME_SHARE = 0.2
+MAX_RETRIES = 4
+BASE_SLEEP_BETWEEN_RETRIES = 2
+
+FailedBulk = collections.namedtuple('FailedBulk', ['bulk', 'logs', 'size_in_bytes', 'error', 'spilled'])
+
 
 class MaxRetriesException(Exception):
     pass
@@ -28,52 +64,215 @@ class UnknownURL(Exception):
     pass
 
 
-class GzipLogRequest(object):
+def _gzip_size_bound(size):
+    # Worst case size of `size` bytes once deflated (zlib's deflateBound) plus
+    # the gzip header and trailer
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13 + 18
+
+
+def _get_retry_after(error):
+    # type: (urllib2.HTTPError) -> float
+    # Retry-After is either a number of seconds or an http date
+    retry_after = error.info() and error.info().get('Retry-After')
+    if not retry_after:
+        return 0
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        import email.utils
+        date = email.utils.parsedate_tz(retry_after)
+        return max(0.0, email.utils.mktime_tz(date) - time.time()) if date else 0
+
+
+def _get_backoff(retries, retry_after):
+    # type: (int, float) -> float
+    # Seconds to sleep before the retries-th retry, a jittered exponential
+    # backoff or as long as the listener's Retry-After asks
+    import random
+    backoff = BASE_SLEEP_BETWEEN_RETRIES * 2 ** retries
+    return max(retry_after, random.uniform(backoff / 2.0, backoff))
+
+
+def _has_time_for(sleep_between_retries, remaining_time_in_millis):
+    # type: (float, Optional[Callable[[], int]]) -> bool
+    if remaining_time_in_millis is not None and \
+            sleep_between_retries * 1000 + RETRY_DEADLINE_MARGIN_IN_MILLIS > remaining_time_in_millis():
+        logger.warning("Not enough time left to try sending logs again")
+        return False
+    return True
+
+
+def _get_attempt_timeout(remaining_time_in_millis):
+    # type: (Optional[Callable[[], int]]) -> Optional[float]
+    # Seconds the listener may stall an attempt, so that the margin is still
+    # left for spilling the bulk when it does. None without a deadline.
+    if remaining_time_in_millis is None:
+        return None
+    return max(MIN_ATTEMPT_TIMEOUT, (remaining_time_in_millis() - RETRY_DEADLINE_MARGIN_IN_MILLIS) / 1000.0)
+
+
+def _is_timeout(error):
+    # type: (urllib2.URLError) -> bool
+    return isinstance(error.reason, socket.timeout)
+
+
+def _handle_http_error(error, on_back_pressure=None):
+    # type: (urllib2.HTTPError, Optional[Callable]) -> float
+    # Raises for the responses that are not worth retrying, returns how long
+    # the listener asked to wait before the next attempt
+    status_code = error.getcode()
+    if status_code == 400:
+        raise BadLogsException(error.reason)
+    elif status_code == 401:
+        raise UnauthorizedAccessException()
+    elif status_code == 404:
+        raise UnknownURL()
+    elif status_code in BACK_PRESSURE_STATUS_CODES:
+        logger.warning("Logz.io is overloaded: {}".format(error))
+        if on_back_pressure is not None:
+            on_back_pressure()
+    else:
+        logger.error("Unknown HTTP exception: {}".format(error))
+    return _get_retry_after(error)
+
+
+def _ensure_workers(max_bulks_in_flight, compress, compress_workers):
+    _sender_pool.ensure_workers(max_bulks_in_flight)
+    if compress:
+        if not compress_workers:
+            import multiprocessing
+            compress_workers = multiprocessing.cpu_count()
+        _compressor_pool.ensure_workers(compress_workers)
+
+
+def _compress_member(data, compress_level):
+    # Runs on a compressor thread, zlib releases the GIL while it deflates
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data), compressor.flush()
 
-    def __init__(self, max_size_in_bytes):
+
+class GzipLogRequest(object):
+    # The body is a series of gzip members of about MEMBER_SIZE_IN_BYTES raw
+    # bytes. Each member is compressed on its own by the compressor threads
+    # while more logs are written, concatenated members are still valid gzip.
+    MEMBER_SIZE_IN_BYTES = 256 * 1024
+    # Caps on the compression level once the invocation runs low on time, as
+    # (milliseconds left, highest level)
+    COMPRESS_LEVEL_CAPS = ((10000, 1), (30000, 6))
+
+    def __init__(self, max_size_in_bytes, compress_level=9, remaining_time_in_millis=None):
         self._max_size_in_bytes = max_size_in_bytes
-        self._decompress_size = 0
-        self._logs_counter = 0
-        self._logs = StringIO.StringIO()
-        self._writer = gzip.GzipFile(mode='wb', fileobj=self._logs)
+        self._compress_level = compress_level
+        self._remaining_time_in_millis = remaining_time_in_millis
+        # Raw members waiting for a compressor are bounded, so that writing
+        # faster than the threads compress doesn't pile them up in memory
+        self._max_pending_members = 2 * max(1, _compressor_pool.workers())
         self._http_headers = {"Content-Encoding": "gzip", "Content-type": "application/json"}
+        self.reset()
 
     def __len__(self):
         return self._logs_counter
 
-    def __str__(self):
-        return self._logs.getvalue()
+    def __iter__(self):
+        # The compressed members as the compressors returned them, without
+        # copying them. Complete after close().
+        return iter(self._chunks)
+
+    def fits(self, log_size):
+        # type: (int) -> bool
+        # Whether a log of log_size bytes can be written without the compressed
+        # request growing past max_size_in_bytes. The size of members that are
+        # not compressed yet is bounded from above, and only when that bound is
+        # too big the request waits for them to get the exact size.
+        if not self._logs_counter:
+            return True
+        log_size += 1
+        self._collect_members(wait=False)
+        if self._compress_size + self._pending_size_bound + \
+                _gzip_size_bound(self._member_size + log_size) <= self._max_size_in_bytes:
+            return True
+        self.flush()
+        return self._compress_size + _gzip_size_bound(log_size) <= self._max_size_in_bytes
 
     def write(self, log):
-        self._writer.write("\n" + log) if self._decompress_size else self._writer.write(log)
-        self._decompress_size += sys.getsizeof(log)
+        if self._logs_counter:
+            log = b"\n" + log
+        self._member.append(log)
+        self._member_size += len(log)
+        self._decompress_size += len(log)
         self._logs_counter += 1
+        if self._member_size >= self.MEMBER_SIZE_IN_BYTES:
+            self._submit_member()
 
     def reset(self):
         self._decompress_size = 0
+        self._compress_size = 0
         self._logs_counter = 0
-        self._logs.truncate(0)
-        self._writer = gzip.GzipFile(mode='wb', fileobj=self._logs)
+        self._chunks = []
+        self._member = []
+        self._member_size = 0
+        self._pending_members = collections.deque()
+        self._pending_size_bound = 0
+        self._closed = False
 
     def decompress_size(self):
         return self._decompress_size
 
     def compress_size(self):
-        old_file_position = self._logs.tell()
-        self._logs.seek(0, os.SEEK_END)
-        size = self._logs.tell()
-        self._logs.seek(old_file_position, os.SEEK_SET)
-        return size
+        # Exact right after flush() or close()
+        return self._compress_size
 
     def close(self):
-        self._writer.close()
+        if not self._closed:
+            if not self._chunks and not self._pending_members and not self._member:
+                # An empty body is still a gzip member
+                self._member.append(b'')
+            self.flush()
+            self._closed = True
 
     def flush(self):
-        self._writer.flush()
+        # Compresses what was written so far and waits for all the members
+        self._submit_member()
+        self._collect_members(wait=True)
 
     def http_headers(self):
         return self._http_headers
 
+    def _submit_member(self):
+        if not self._member:
+            return
+        if len(self._pending_members) >= self._max_pending_members:
+            self._collect_member()
+
+        data = b''.join(self._member)
+        self._member = []
+        self._member_size = 0
+        future = _compressor_pool.submit(_compress_member, data, self._get_compress_level())
+        self._pending_members.append((future, len(data)))
+        self._pending_size_bound += _gzip_size_bound(len(data))
+
+    def _collect_members(self, wait):
+        # Accounts for the members that are compressed, in order
+        while self._pending_members and (wait or self._pending_members[0][0].done()):
+            self._collect_member()
+
+    def _collect_member(self):
+        future, raw_size = self._pending_members.popleft()
+        for chunk in future.result():
+            if chunk:
+                self._chunks.append(chunk)
+                self._compress_size += len(chunk)
+        self._pending_size_bound -= _gzip_size_bound(raw_size)
+
+    def _get_compress_level(self):
+        compress_level = self._compress_level
+        if self._remaining_time_in_millis is not None:
+            remaining_time = self._remaining_time_in_millis()
+            for time_left, max_compress_level in self.COMPRESS_LEVEL_CAPS:
+                if remaining_time < time_left:
+                    return min(compress_level, max_compress_level)
+        return compress_level
+
 
 class StringLogRequest(object):
 
@@ -86,12 +285,32 @@ class StringLogRequest(object):
     def __len__(self):
         return len(self._logs)
 
-    def __str__(self):
-        return '\n'.join(self._logs)
+    def __iter__(self):
+        # The body in pieces of about BODY_CHUNK_SIZE bytes, so only one piece
+        # at a time is copied instead of the whole body
+        logs = self._logs
+        start = 0
+        chunk_size = 0
+        separator = b''
+        for index, log in enumerate(logs):
+            chunk_size += len(log) + 1
+            if chunk_size >= BODY_CHUNK_SIZE:
+                yield separator + b'\n'.join(logs[start:index + 1])
+                separator = b'\n'
+                start = index + 1
+                chunk_size = 0
+        if start < len(logs):
+            yield separator + b'\n'.join(logs[start:])
+
+    def fits(self, log_size):
+        # type: (int) -> bool
+        return not self._logs or self._size + 1 + log_size <= self._max_size_in_bytes
 
     def write(self, log):
+        if self._logs:
+            self._size += 1
         self._logs.append(log)
-        self._size += sys.getsizeof(log)
+        self._size += len(log)
 
     def reset(self):
         self._size = 0
@@ -115,99 +334,270 @@ class StringLogRequest(object):
 
 class LogzioShipper(object):
     MAX_BULK_SIZE_IN_BYTES = 3 * 1024 * 1024
-
-    def __init__(self, logzio_url):
+    MAX_BULKS_IN_FLIGHT = 4
+
+    def __init__(self, logzio_url, max_bulks_in_flight=MAX_BULKS_IN_FLIGHT,
+                 max_bulk_size_in_bytes=MAX_BULK_SIZE_IN_BYTES, compress=False, codec=None,
+                 compress_level=9, compress_workers=0, remaining_time_in_millis=None, spill_queue=None,
+                 metrics=None):
+        # compress_workers defaults to a thread per CPU, remaining_time_in_millis
+        # is the Lambda context's get_remaining_time_in_millis. Bulks that can't
+        # be sent are kept in spill_queue, when there is one, instead of failing.
+        # What is sent is recorded in metrics, an InvocationMetrics.
         self._logzio_url = logzio_url
-        try:
-            self._compress = os.environ['COMPRESS'].lower() == "true"
-        except KeyError:
-            self._compress = False
-        self._logs = GzipLogRequest(self.MAX_BULK_SIZE_IN_BYTES) \
+        self._spill_queue = spill_queue
+        self._metrics = metrics
+        self._compress_level = compress_level
+        self._remaining_time_in_millis = remaining_time_in_millis
+        self._base_codec = codec or get_codec('json')
+        self._codec = self._base_codec
+        self._max_bulk_size_in_bytes = max_bulk_size_in_bytes
+        self._bulk_size_in_bytes = max_bulk_size_in_bytes
+        self._compress = compress
+        self._max_bulks_in_flight = max(1, max_bulks_in_flight)
+        self._bulks_in_flight = collections.deque()
+        self._bulks_sent = 0
+        self.failed_bulks = []
+        self._start_workers(compress, compress_workers)
+        self._logs = self._new_request()
+
+    def _start_workers(self, compress, compress_workers):
+        _ensure_workers(self._max_bulks_in_flight, compress, compress_workers)
+
+    def _new_request(self):
+        return GzipLogRequest(self._bulk_size_in_bytes, self._compress_level, self._remaining_time_in_millis) \
             if self._compress \
-            else StringLogRequest(self.MAX_BULK_SIZE_IN_BYTES)
+            else StringLogRequest(self._bulk_size_in_bytes)
+
+    def set_shared_fields(self, fields):
+        # type: (dict) -> None
+        # Fields added to every log from now on, serialized only once
+        self._codec = self._base_codec.with_shared_fields(fields)
 
     def add(self, log):
         # type: (dict) -> None
-        json_log = json.dumps(log).encode('utf-8')
-        self._logs.write(json_log)
-        # To prevent flush() after every log added
-        if self._logs.decompress_size() > self.MAX_BULK_SIZE_IN_BYTES:
-            self._logs.flush()
-            self._try_to_send()
+        self._add_json_log(self._codec.dumps(log))
 
-    def _reset(self):
-        self._logs.reset()
+    def add_record(self, record):
+        # type: (LogRecord) -> None
+        self._add_json_log(self._codec.dumps_record(record))
 
-    def _try_to_send(self):
-        if self._logs.compress_size() > self.MAX_BULK_SIZE_IN_BYTES:
-            self._send_to_logzio()
-            self._reset()
+    def add_many(self, logs):
+        # type: (Iterable[dict]) -> None
+        for json_log in self._codec.dumps_many(logs):
+            self._add_json_log(json_log)
+
+    def _add_json_log(self, json_log):
+        # Send the bulk before it would grow past the maximum size
+        if not self._logs.fits(len(json_log)):
+            self._send_in_background()
+        self._logs.write(json_log)
+
+    def _send_in_background(self):
+        # Hands the current bulk to the sender threads and starts a new one.
+        # Blocks while the maximum number of bulks is already in flight.
+        self._wait_for_bulks(self._max_bulks_in_flight - 1)
+        logs, self._logs = self._logs, self._new_request()
+        self._bulks_sent += 1
+        self._bulks_in_flight.append(self._submit(logs, self._bulks_sent))
+
+    def _submit(self, logs, bulk):
+        # type: (...) -> Future
+        return _sender_pool.submit(self._send_to_logzio, logs, bulk)
+
+    def _wait_for_bulks(self, max_bulks_in_flight):
+        while len(self._bulks_in_flight) > max_bulks_in_flight:
+            try:
+                self._bulks_in_flight.popleft().result()
+            except Exception:
+                # Let the other bulks finish before failing the invocation
+                self._wait_for_bulks(0)
+                raise
 
     def flush(self):
-        if self._logs.compress_size():
-            self._logs.flush()
-            self._send_to_logzio()
-            self._reset()
+        if len(self._logs):
+            self._send_in_background()
+        try:
+            self._wait_for_bulks(0)
+        finally:
+            if self.failed_bulks:
+                logger.warning("{} of {} bulks failed: {}".format(
+                    len(self.failed_bulks), self._bulks_sent,
+                    ", ".join("bulk {} ({} logs, {})".format(failed.bulk, failed.logs,
+                                                            "spilled" if failed.spilled else failed.error)
+                              for failed in sorted(self.failed_bulks))))
 
     @staticmethod
-    def retry(func):
+    def retry(func, remaining_time_in_millis=None, on_back_pressure=None):
+        # Retries with a jittered exponential backoff, or as long as the
+        # listener's Retry-After asks. Gives up early when the invocation would
+        # time out before the next attempt. Attempts that time out are retried
+        # too. on_back_pressure is called when the listener answers 429 or 503.
         def retry_func():
-            max_retries = 4
-            sleep_between_retries = 2
+            retry_after = 0
 
-            for retries in xrange(max_retries):
+            for retries in range(MAX_RETRIES):
                 if retries:
-                    sleep_between_retries *= 2
-                    logger.info("Failure in sending logs - Trying again in {} seconds"
+                    sleep_between_retries = _get_backoff(retries, retry_after)
+                    if not _has_time_for(sleep_between_retries, remaining_time_in_millis):
+                        break
+                    logger.info("Failure in sending logs - Trying again in {:.1f} seconds"
                                 .format(sleep_between_retries))
                     time.sleep(sleep_between_retries)
                 try:
                     res = func()
                 except urllib2.HTTPError as e:
-                    status_code = e.getcode()
-                    if status_code == 400:
-                        raise BadLogsException(e.reason)
-                    elif status_code == 401:
-                        raise UnauthorizedAccessException()
-                    elif status_code == 404:
-                        raise UnknownURL()
-                    else:
-                        logger.error("Unknown HTTP exception: {}".format(e))
-                        continue
-                except urllib2.URLError:
-                    raise
+                    retry_after = _handle_http_error(e, on_back_pressure)
+                    continue
+                except urllib2.URLError as e:
+                    if not _is_timeout(e):
+                        raise
+                    logger.warning("Logz.io didn't answer in time: {}".format(e))
+                    continue
                 return res
 
             raise MaxRetriesException()
 
         return retry_func
 
-    def _send_to_logzio(self):
-        @LogzioShipper.retry
-        def do_request():
-            self._logs.close()
-            request = urllib2.Request(self._logzio_url, data=str(self._logs), headers=self._logs.http_headers())
-            return urllib2.urlopen(request)
+    def _shrink_bulks(self):
+        # Called from the sender threads, new bulks are half as big until one is
+        # accepted again
+        bulk_size_in_bytes = max(MIN_BULK_SIZE_IN_BYTES, self._bulk_size_in_bytes // 2)
+        if bulk_size_in_bytes < self._bulk_size_in_bytes:
+            logger.info("Sending bulks of up to {} bytes".format(bulk_size_in_bytes))
+            self._bulk_size_in_bytes = bulk_size_in_bytes
+
+    def _grow_bulks(self):
+        self._bulk_size_in_bytes = min(self._max_bulk_size_in_bytes, self._bulk_size_in_bytes * 2)
+
+    def send_spilled(self, max_size_in_bytes):
+        # type: (int) -> int
+        # Sends the bulks spilled by earlier invocations, oldest first, until
+        # max_size_in_bytes were sent or SPILL_DRAIN_TIME_SHARE of the remaining
+        # time is used up. Stops at the first bulk that fails or times out, the
+        # endpoint is most likely still unavailable.
+        if self._spill_queue is None:
+            return 0
+        deadline = None
+        if self._remaining_time_in_millis is not None:
+            deadline = timer() + self._remaining_time_in_millis() / 1000.0 * SPILL_DRAIN_TIME_SHARE
+        logs_counter = 0
+        for logs in self._spill_queue.requests(max_size_in_bytes):
+            timeout = SPILL_DRAIN_ATTEMPT_TIMEOUT
+            if deadline is not None:
+                timeout = min(timeout, deadline - timer())
+                if timeout < MIN_ATTEMPT_TIMEOUT:
+                    logger.info("No time left for spilled bulks, keeping the rest for later")
+                    break
+            try:
+                self._post(logs, timeout)
+            except urllib2.HTTPError as e:
+                if e.getcode() != 400:
+                    logger.warning("Failed to send a spilled bulk, keeping it for later: {}".format(e))
+                    break
+                logger.error("Got 400 code from Logz.io, dropping a spilled bulk of {} logs".format(len(logs)))
+            except urllib2.URLError as e:
+                logger.warning("Failed to send a spilled bulk, keeping it for later: {}".format(e))
+                break
+            else:
+                logs_counter += len(logs)
+                if self._metrics is not None:
+                    self._metrics.add('SpilledLogsSent', len(logs))
+            self._spill_queue.remove(logs.path)
+        if logs_counter:
+            logger.info("Sent {} spilled logs".format(logs_counter))
+        return logs_counter
+
+    def _record_failure(self, logs, bulk, error, spill=True):
+        # Keeps track of the bulks that failed and spills them when possible,
+        # True when the bulk was spilled
+        spilled = spill and self._spill_queue is not None and self._spill_queue.put(logs)
+        if spilled:
+            logger.warning("Spilled bulk {} of {} logs, it will be sent by a later invocation".format(bulk, len(logs)))
+        self.failed_bulks.append(FailedBulk(bulk, len(logs), logs.compress_size(), error, spilled))
+        if self._metrics is not None:
+            self._metrics.add('FailedBulks', 1)
+            self._metrics.add('SpilledBulks', int(spilled))
+        return spilled
+
+    def _post(self, logs, timeout=None):
+        # timeout defaults to the one _get_attempt_timeout allows
+        if timeout is None:
+            timeout = _get_attempt_timeout(self._remaining_time_in_millis)
+        logs.close()
+        headers = dict(logs.http_headers())
+        headers['Content-Length'] = str(logs.compress_size())
+        start = timer()
+        try:
+            status, reason, response_headers, body = _connection_pool.request(
+                'POST', self._logzio_url, logs, headers, timeout)
+        except CONNECTION_ERRORS as e:
+            raise urllib2.URLError(e)
+        finally:
+            if self._metrics is not None:
+                self._metrics.add_latency(timer() - start)
+        if status >= 400:
+            raise urllib2.HTTPError(self._logzio_url, status, reason, response_headers, None)
+        return body
+
+    def _send_to_logzio(self, logs, bulk):
+        first_attempt = [True]
+
+        def attempt():
+            if not first_attempt[0] and self._metrics is not None:
+                self._metrics.add('Retries', 1)
+            first_attempt[0] = False
+            return self._post(logs)
+        do_request = LogzioShipper.retry(attempt, self._remaining_time_in_millis, self._shrink_bulks)
 
         try:
             do_request()
-            logger.info("Successfully sent bulk of {} logs to Logz.io!".format(len(self._logs)))
-        except MaxRetriesException:
+        except Exception as e:
+            if self._handle_failure(logs, bulk, e):
+                return
+            raise
+        self._handle_success(logs)
+
+    def _handle_success(self, logs):
+        logger.info("Successfully sent bulk of {} logs to Logz.io!".format(len(logs)))
+        self._grow_bulks()
+        if self._metrics is not None:
+            self._metrics.add('Bulks', 1)
+            self._metrics.add('BytesSent', logs.compress_size(), BYTES)
+            self._metrics.add('UncompressedBytes', logs.decompress_size(), BYTES)
+
+    def _handle_failure(self, logs, bulk, error):
+        # Logs why a bulk couldn't be sent, True when it was spilled and the
+        # error shouldn't fail the invocation
+        if isinstance(error, MaxRetriesException):
             logger.error('Retry limit reached. Failed to send log entry.')
-            raise MaxRetriesException()
-        except BadLogsException as e:
+            return self._record_failure(logs, bulk, 'retry limit reached')
+        elif isinstance(error, BadLogsException):
             logger.error("Got 400 code from Logz.io. This means that some of your logs are too big, "
-                         "or badly formatted. response: {0}".format(e.message))
-            raise BadLogsException()
-        except UnauthorizedAccessException:
+                         "or badly formatted. response: {0}".format(error))
+            self._record_failure(logs, bulk, 'bad logs', spill=False)
+        elif isinstance(error, UnauthorizedAccessException):
             logger.error("You are not authorized with Logz.io! Token OK? dropping logs...")
-            raise UnauthorizedAccessException()
-        except UnknownURL:
+        elif isinstance(error, UnknownURL):
             logger.error("Please check your url...")
-            raise UnknownURL()
-        except urllib2.HTTPError as e:
-            logger.error("Unexpected error while trying to send logs: {}".format(e))
-            raise
-        except Exception as e:
-            logger.error(e)
-            raise
+        elif isinstance(error, urllib2.HTTPError):
+            logger.error("Unexpected error while trying to send logs: {}".format(error))
+        elif isinstance(error, urllib2.URLError):
+            logger.error("Failed to connect to Logz.io: {}".format(error))
+            return self._record_failure(logs, bulk, 'connection failed')
+        else:
+            logger.error(error)
+        return False
+
+
+def prepare(logzio_url, max_bulks_in_flight=LogzioShipper.MAX_BULKS_IN_FLIGHT, compress=False, compress_workers=0,
+            connect_timeout=2):
+    # type: (str, int, bool, int, float) -> None
+    # Starts the threads and opens a connection to the listener ahead of the
+    # first shipper, e.g. while the Lambda container initializes
+    _ensure_workers(max(1, max_bulks_in_flight), compress, compress_workers)
+    try:
+        _connection_pool.open_connection(logzio_url, connect_timeout)
+    except CONNECTION_ERRORS as e:
+        logger.info("Failed to connect to Logz.io ahead of time: {!r}".format(e))
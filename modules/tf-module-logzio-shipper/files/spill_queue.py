@@ -0,0 +1,147 @@
+import binascii
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger()
+
+DEFAULT_SPILL_DIRECTORY = '/tmp/logzio-spill'
+SPILL_FILE_SUFFIX = '.bulk'
+
+
+class SpilledRequest(object):
+    # A bulk read back from the spill queue. It is already serialized and
+    # compressed, so it is sent as it is.
+
+    def __init__(self, path, logs, headers, body):
+        self.path = path
+        self._logs = logs
+        self._headers = headers
+        self._body = body
+
+    def __len__(self):
+        return self._logs
+
+    def __iter__(self):
+        return iter((self._body,))
+
+    def close(self):
+        pass
+
+    def compress_size(self):
+        return len(self._body)
+
+    def http_headers(self):
+        return self._headers
+
+
+class SpillQueue(object):
+    # Bulks that could not be sent, kept in a local directory until a later
+    # invocation sends them. /tmp lives as long as the container, so the bulks
+    # are picked up by the next warm invocation without being decoded, parsed
+    # and compressed again.
+    #
+    # Every bulk is a file holding a json header line (number of logs and the
+    # http headers) followed by the body. Files are written next to their final
+    # name and renamed, so a bulk is either complete or not there.
+
+    def __init__(self, directory=DEFAULT_SPILL_DIRECTORY, max_size_in_bytes=256 * 1024 * 1024):
+        self._directory = directory
+        self._max_size_in_bytes = max_size_in_bytes
+        self._lock = threading.Lock()
+        self._size = None
+
+    def __len__(self):
+        return len(self._files())
+
+    def size(self):
+        with self._lock:
+            return self._get_size()
+
+    def put(self, logs):
+        # type: (Iterable[bytes]) -> bool
+        # Spills a closed request, False when it doesn't fit in the queue
+        header = json.dumps({'logs': len(logs), 'headers': dict(logs.http_headers())}).encode('utf-8') + b'\n'
+        size = len(header) + logs.compress_size()
+        with self._lock:
+            if self._get_size() + size > self._max_size_in_bytes:
+                return False
+            self._size += size
+
+        name = "{:017d}-{}".format(int(time.time() * 1000000), binascii.hexlify(os.urandom(8)).decode('ascii'))
+        path = os.path.join(self._directory, name + SPILL_FILE_SUFFIX)
+        temp_path = os.path.join(self._directory, '.' + name)
+        try:
+            if not os.path.isdir(self._directory):
+                try:
+                    os.makedirs(self._directory)
+                except OSError:
+                    # Created by another thread in the meantime
+                    if not os.path.isdir(self._directory):
+                        raise
+            with open(temp_path, 'wb') as spill_file:
+                spill_file.write(header)
+                for chunk in logs:
+                    spill_file.write(chunk)
+            os.rename(temp_path, path)
+        except (IOError, OSError) as e:
+            logger.error("Failed to spill a bulk to {}: {}".format(self._directory, e))
+            self._remove_file(temp_path)
+            with self._lock:
+                self._size -= size
+            return False
+        return True
+
+    def requests(self, max_size_in_bytes):
+        # type: (int) -> Iterator[SpilledRequest]
+        # The spilled bulks, oldest first, until max_size_in_bytes were read.
+        # A bulk stays in the queue until it is removed.
+        read_size = 0
+        for name in self._files():
+            if read_size >= max_size_in_bytes:
+                return
+            path = os.path.join(self._directory, name)
+            try:
+                with open(path, 'rb') as spill_file:
+                    header = json.loads(spill_file.readline().decode('utf-8'))
+                    body = spill_file.read()
+            except (IOError, OSError, ValueError) as e:
+                logger.error("Dropping unreadable spilled bulk {}: {}".format(path, e))
+                self.remove(path)
+                continue
+            read_size += len(body)
+            yield SpilledRequest(path, header['logs'], header['headers'], body)
+
+    def remove(self, path):
+        # type: (str) -> None
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        if self._remove_file(path):
+            with self._lock:
+                if self._size is not None:
+                    self._size -= size
+
+    def _files(self):
+        try:
+            names = os.listdir(self._directory)
+        except OSError:
+            return []
+        return sorted(name for name in names if name.endswith(SPILL_FILE_SUFFIX))
+
+    def _get_size(self):
+        # Bulks left by earlier invocations of the container are counted once
+        if self._size is None:
+            self._size = sum(os.path.getsize(os.path.join(self._directory, name)) for name in self._files())
+        return self._size
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
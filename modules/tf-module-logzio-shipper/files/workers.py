@@ -0,0 +1,70 @@
+import threading
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+
+class Future(object):
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        # Blocks until the task finished and re-raises its exception if it failed
+        self._done.wait()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+
+class WorkerPool(object):
+    # Daemon threads that run submitted tasks. Threads are only started when
+    # needed and are kept for the lifetime of the process, so a module level
+    # pool is reused across warm Lambda invocations.
+
+    def __init__(self, name):
+        self._name = name
+        self._queue = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def workers(self):
+        return len(self._threads)
+
+    def ensure_workers(self, workers):
+        with self._lock:
+            while len(self._threads) < workers:
+                thread = threading.Thread(target=self._work, name="{}-{}".format(self._name, len(self._threads)))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, func, *args):
+        # type: (Callable, ...) -> Future
+        self.ensure_workers(1)
+        future = Future()
+        self._queue.put((future, func, args))
+        return future
+
+    def _work(self):
+        while True:
+            future, func, args = self._queue.get()
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
@@ -13,9 +13,9 @@ resource "aws_lambda_function" "this" {
   source_code_hash = "${data.archive_file.this.output_base64sha256}"
   description      = "This function ship cloudwatch logs to Logz.io"
   function_name    = "${var.function_name}"
-  handler          = "lambda_function.lambda_handler"
+  handler          = "${var.handler}"
   role             = "${var.iam_role}"
-  runtime          = "python2.7"
+  runtime          = "${var.runtime}"
   memory_size      = "${var.memory_size}"
   timeout          = "${var.timeout}"
 
@@ -27,6 +27,30 @@ resource "aws_lambda_function" "this" {
       TYPE     = "${var.log_type}"
       COMPRESS = "${var.log_compression}"
       ENRICH   = "${var.log_enrich}"
+
+      MAX_BULKS_IN_FLIGHT = "${var.max_bulks_in_flight}"
+      MAX_BULK_SIZE       = "${var.max_bulk_size_in_bytes}"
+      JSON_CODEC          = "${var.json_codec}"
+      COMPRESS_LEVEL      = "${var.log_compression_level}"
+      COMPRESS_WORKERS    = "${var.log_compression_workers}"
+
+      SPILL_DIRECTORY  = "${var.spill_directory}"
+      SPILL_MAX_SIZE   = "${var.spill_max_size_in_bytes}"
+      SPILL_DRAIN_SIZE = "${var.spill_drain_size_in_bytes}"
+
+      METRICS_NAMESPACE = "${var.metrics_namespace}"
+
+      MIN_LEVEL        = "${var.min_level}"
+      DROP_PATTERNS    = "${jsonencode(var.drop_patterns)}"
+      SAMPLING         = "${var.sampling}"
+      RATE_LIMIT       = "${var.rate_limit_bytes_per_second}"
+      RATE_LIMIT_BURST = "${var.rate_limit_burst_bytes}"
+
+      DEDUP             = "${var.dedup}"
+      DEDUP_MAX_ENTRIES = "${var.dedup_max_entries}"
+      DEDUP_WINDOW      = "${var.dedup_window_seconds}"
+
+      ENGINE = "${var.engine}"
     }
   }
 
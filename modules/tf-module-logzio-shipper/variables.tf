@@ -41,11 +41,112 @@ variable "log_compression" {
   default     = "false"
 }
 
+variable "log_compression_level" {
+  description = "The gzip level (1-9) used when log_compression is true. It is lowered automatically when the invocation runs low on time."
+  default     = 9
+}
+
+variable "log_compression_workers" {
+  description = "The number of threads compressing logs when log_compression is true. 0 uses one thread per vCPU of the function."
+  default     = 0
+}
+
+variable "spill_directory" {
+  description = "Where bulks that failed to be sent are kept until a later invocation of the same container sends them"
+  default     = "/tmp/logzio-spill"
+}
+
+variable "spill_max_size_in_bytes" {
+  description = "The maximum size of the bulks kept in spill_directory, 0 disables spilling. When it is full, or disabled, failing to send a bulk fails the invocation, so Lambda retries it. A spilled bulk makes the invocation succeed, and it is lost when the container is recycled before a later invocation sends it."
+  default     = 0
+}
+
+variable "spill_drain_size_in_bytes" {
+  description = "How much of the spilled bulks an invocation sends before its own logs"
+  default     = 16777216
+}
+
+variable "metrics_namespace" {
+  description = "The CloudWatch namespace of the metrics the Lambda writes to its log after every invocation, in the Embedded Metric Format, e.g. LogzioShipper. They are billed as custom metrics. Empty disables them."
+  default     = ""
+}
+
+variable "min_level" {
+  description = "Logs with a lower level are dropped, e.g. INFO drops TRACE and DEBUG logs. Logs without a level are always shipped. Empty ships all levels."
+  default     = ""
+}
+
+variable "drop_patterns" {
+  type        = "list"
+  description = "Regular expressions, logs whose message matches one of them are dropped"
+  default     = []
+}
+
+variable "sampling" {
+  description = "The share of the logs of a log group that is shipped. The format is pattern1=rate1;pattern2=rate2, e.g. /aws/lambda/noisy-*=0.1. The first pattern that matches the log group applies."
+  default     = ""
+}
+
+variable "rate_limit_bytes_per_second" {
+  description = "The average rate of log messages, in bytes per second, a container ships. Logs over the limit are dropped. 0 disables the limit."
+  default     = 0
+}
+
+variable "rate_limit_burst_bytes" {
+  description = "The bytes of log messages that can be shipped at once under the rate limit. 0 uses rate_limit_bytes_per_second."
+  default     = 0
+}
+
+variable "dedup" {
+  description = "Ship a message of a log group once per dedup window and fold its repeats into a summary log with repeat_count, first_timestamp and last_timestamp"
+  default     = "false"
+}
+
+variable "dedup_max_entries" {
+  description = "How many recent messages the dedup cache of a shipper container remembers"
+  default     = 10000
+}
+
+variable "dedup_window_seconds" {
+  description = "How long, in seconds of log event time, repeats of a shipped message are folded"
+  default     = 60
+}
+
 variable "log_enrich" {
   description = "Enriche CloudWatch events with custom properties at shipping time. The format is key1=value1;key2=value2"
   default     = ""
 }
 
+variable "handler" {
+  description = "lambda_function.lambda_handler for CloudWatch Logs subscriptions that invoke the function, lambda_function.records_handler for subscriptions delivered through a Kinesis data stream or a Firehose delivery stream"
+  default     = "lambda_function.lambda_handler"
+}
+
+variable "runtime" {
+  description = "The Lambda runtime of the shipper, python2.7 or a python3 runtime"
+  default     = "python2.7"
+}
+
+variable "engine" {
+  description = "What sends the bulks: threads, or asyncio, an event loop with non-blocking connections that needs a python3 runtime"
+  default     = "threads"
+}
+
+variable "max_bulks_in_flight" {
+  description = "The maximum number of bulks the Lambda sends to Logz.io concurrently"
+  default     = 4
+}
+
+variable "max_bulk_size_in_bytes" {
+  description = "The size a bulk sent to Logz.io is filled up to, after compression when log_compression is true"
+  default     = 3145728
+}
+
+variable "json_codec" {
+  description = "auto, json, simplejson, ujson or orjson. auto keeps the json output of the standard library and only decodes messages with the fastest library packaged with the function. Naming ujson or orjson uses it for encoding too, which writes compact json."
+  default     = "auto"
+}
+
 variable "iam_path" {
   description = "(Optional) The path to the role. See https://docs.aws.amazon.com/IAM/latest/UserGuide/reference_identifiers.html for more information."
   default     = "/"